@@ -3,7 +3,7 @@ from sqlalchemy.orm import Session
 from app.schemas.user import UserLogin
 from app.schemas.auth import TokenBase
 from app.models.user import User # Import the User ORM model (i.e. the database model for the User table)
-from app.core.security import verify_password, create_token, verify_token, is_token_revoked, revoke_token, get_current_user
+from app.core.security import verify_password, create_token, verify_token, revoke_token, get_current_user
 from app.db.base import get_db
 import datetime
 
@@ -34,17 +34,15 @@ def login(request: Request, user: UserLogin = Form(...), db: Session = Depends(g
 
 @router.post("/refresh")
 # refresh the access token. Refresh is included as Header in the request.
-def refresh_token(refresh: str = Header(...), response_model=TokenBase):
+async def refresh_token(refresh: str = Header(...), response_model=TokenBase):
     # Verify the refresh token
     payload = verify_token(refresh)
     print("Payload:", payload)
     if payload["type"] != "refresh":
         raise HTTPException(status_code=400, detail="Invalid token type")
-    # Check if the token is revoked
-    if is_token_revoked(refresh):
+    # Revoke the refresh token. This fails if the token is already revoked (checked and revoked in one step).
+    if not await revoke_token(refresh):
         raise HTTPException(status_code=401, detail="Token has been revoked")
-    # Next revoke the refresh token
-    revoke_token(refresh)
     print("Have revoked token, now creating new token (refresh)")
     # Create a new access token and return it. Rotate the refresh token. TODO: this is hardcoded!!! Fix this.
     # Also, there is a problem if a token is revoked too fast after creation. The new token will be revoked too (it is the same token).
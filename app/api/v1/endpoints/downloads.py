@@ -1,21 +1,26 @@
 import uuid
+from typing import Optional
 from datetime import timedelta
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from fastapi import APIRouter, Depends, HTTPException, Form, UploadFile, Body
 from fastapi import File as FileField
 from starlette.responses import FileResponse
 from app.core.security import get_current_user
-from app.db.base import get_db
+from app.db.base import get_async_db
 from app.models.file import File
 from app.models.job import Job
 from app.models.file import FileTypeEnum
 from app.schemas.file import FileResponseBase, FileUploadRequestBase, FileUploadResponseBase, FileDownloadRequestBase
-from app.core.redis import redis_client
+from app.core.redis import async_redis_client
 import json
 import os
 from app.core.config import FileHandlingConfig
-import aiofiles
+import asyncio
+import errno
+import hashlib
 from app.core.job_manager import job_manager
+from app.core.upload_manager import upload_manager, remove_part_file
 import datetime
 router = APIRouter()
 cfg = FileHandlingConfig()
@@ -27,7 +32,7 @@ import json
 # File Download API #
 ######################
 
-def generate_download_link(file_id: str, current_user: dict, db: Session):
+async def generate_download_link(file_id: str, current_user: dict):
     """
     Generate a one-time-use download link for a file, associated with the requesting user.
     """
@@ -38,33 +43,39 @@ def generate_download_link(file_id: str, current_user: dict, db: Session):
 
     # Step 3: Store token in Redis with file path + user ID (expires in 5 minutes)
     token_data = json.dumps({"file_id": file_id, "user_id": current_user["sub"]})
-    redis_client.setex(token, timedelta(seconds=cfg.download_link_ttl), token_data)
+    await async_redis_client.setex(token, timedelta(seconds=cfg.download_link_ttl), token_data)
 
     # Step 4: Return the secure download link
     return {"download_url": f"/files/download/{token}"}
 
 @router.post("/request-download")
-def request_download(file_req: FileDownloadRequestBase = Body(...), db: Session = Depends(get_db),current_user: dict = Depends(get_current_user), response_model = FileResponseBase):
+async def request_download(file_req: FileDownloadRequestBase = Body(...), db: AsyncSession = Depends(get_async_db),current_user: dict = Depends(get_current_user), response_model = FileResponseBase):
     """
     Request a secure download link for a file.
     Validates that the file exists and generates a one-time token for the requesting user.
     """
     # Step 1: Check if the file exists
-    file = db.query(File).filter(File.id == file_req.file_id).first()
+    file = await db.get(File, file_req.file_id)
     if not file:
         raise HTTPException(status_code=404, detail="File not found")
     # TODO: implement a check to see if the user should be able to access this file!
 
-    # Step 2: Generate a one-time download token (linked to the user)
-    return generate_download_link(file_req.file_id, current_user, db)
+    # Step 2: Generate a one-time download token (linked to the user). Include the file digest, to verify the download or skip it.
+    link = await generate_download_link(file_req.file_id, current_user)
+    link.update({"digest": file.digest, "chunk_size": file.chunk_size})
+    return link
 
 @router.get("/download/{token}")
-async def download_file(token: str, current_user: dict = Depends(get_current_user), db: Session = Depends(get_db)):
+async def download_file(token: str, current_user: dict = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
     """
     Serve a file if the provided token is valid and belongs to the requesting user.
     """
-    # Step 1: Retrieve token data from Redis
-    token_data = redis_client.get(token)
+    # Step 1: Retrieve token data from Redis and invalidate the token (one-time use), in one atomic round trip.
+    # Two concurrent requests with the same token cannot both get it.
+    pipe = async_redis_client.pipeline(transaction=True)
+    pipe.get(token)
+    pipe.delete(token)
+    token_data, _ = await pipe.execute()
     if not token_data:
         raise HTTPException(status_code=403, detail="Invalid or expired token")
 
@@ -78,7 +89,7 @@ async def download_file(token: str, current_user: dict = Depends(get_current_use
         raise HTTPException(status_code=403, detail="Unauthorized access")
 
     # get the file path
-    file = db.query(File).filter(File.id == file_id).first()
+    file = await db.get(File, file_id)
     if not file:
         raise HTTPException(status_code=404, detail="File not found")
     #check it points to a file
@@ -86,11 +97,12 @@ async def download_file(token: str, current_user: dict = Depends(get_current_use
         raise HTTPException(status_code=404, detail="Invalid path. The file does not exist.")
 
     file_path = file.full_path
-    # Step 4: Invalidate token (one-time use)
-    redis_client.delete(token)
 
-    # Step 5: Return the file as a response. TODO: Check the file path is right?
-    return FileResponse(file_path, filename=file_path.split("/")[-1], media_type="application/octet-stream")
+    # Step 4: Return the file as a response, with its digest. TODO: Check the file path is right?
+    headers = {}
+    if file.digest:
+        headers = {"X-File-Digest": file.digest, "X-File-Digest-Chunk-Size": str(file.chunk_size)}
+    return FileResponse(file_path, filename=file_path.split("/")[-1], media_type="application/octet-stream", headers=headers)
 
 
 
@@ -98,7 +110,59 @@ async def download_file(token: str, current_user: dict = Depends(get_current_use
 #   File Upload API  #
 ######################
 
-def generate_upload_link(current_user: dict):
+# Chunks are written straight to their offset in a preallocated part file next to the final file, then the part file is renamed.
+# Every chunk but the last must be exactly cfg.chunk_size bytes long, so that chunk i starts at (i - 1) * cfg.chunk_size.
+
+class ChunkDigestMismatch(Exception):
+    """The digest of a received chunk does not match the one sent by the client."""
+
+def write_chunk(part_path: str, offset: int, data: bytes, preallocate: int, expected_digest: str = None) -> str:
+    """
+    Hash a chunk, then write it at its offset in the part file. The first chunk written creates and preallocates the file. Blocking, run it in a thread.
+    Only call it between upload_manager.begin_write and mark_received, so that the part file is never written (or created again) once the upload is finalized.
+    If the client sent the digest of the chunk, a corrupted chunk is rejected (ChunkDigestMismatch) before being written.
+    Returns: the SHA-256 hex digest of the chunk.
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    if expected_digest and expected_digest.lower() != digest:
+        raise ChunkDigestMismatch(f"Chunk digest mismatch: expected {expected_digest}, got {digest}")
+    try:
+        fd = os.open(part_path, os.O_WRONLY)
+    except FileNotFoundError:
+        # Concurrent first chunks may all create and preallocate the part file, both are idempotent
+        fd = os.open(part_path, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            os.posix_fallocate(fd, 0, preallocate)
+        except AttributeError:
+            # Not supported by the platform, the file then grows as chunks are written
+            pass
+        except OSError as e:
+            # Same if not supported by the file system. Other errors (e.g. no space left) fail the chunk.
+            if e.errno not in (errno.EOPNOTSUPP, errno.ENOSYS, errno.EINVAL):
+                os.close(fd)
+                raise
+    try:
+        os.pwrite(fd, data, offset)
+    finally:
+        os.close(fd)
+    return digest
+
+def finalize_part_file(part_path: str, file_path: str, size: int):
+    """
+    Cut the part file to the real file size, flush it to disk and move it to its final path. Blocking, run it in a thread.
+    Idempotent: a retried finalization skips the move if an earlier attempt already did it.
+    """
+    if not os.path.exists(part_path) and os.path.exists(file_path):
+        return
+    fd = os.open(part_path, os.O_WRONLY)
+    try:
+        os.ftruncate(fd, size)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.replace(part_path, file_path)
+
+async def generate_upload_link(current_user: dict):
     """
     Generate a one-time secure upload link after a job is completed.
     """
@@ -109,17 +173,17 @@ def generate_upload_link(current_user: dict):
     token_data = json.dumps({
         "user_id": current_user["sub"],
     })
-    redis_client.setex(token, timedelta(seconds=cfg.upload_link_ttl), token_data)
+    await async_redis_client.setex(token, timedelta(seconds=cfg.upload_link_ttl), token_data)
 
-    # Step 4: Return the secure upload link
-    return {"upload_url": f"/files/upload/{token}"}
+    # Step 4: Return the secure upload link, and the size of the chunks to send
+    return {"upload_url": f"/files/upload/{token}", "chunk_size": cfg.chunk_size}
 
 @router.post("/request-upload")
-def request_upload(current_user: dict = Depends(get_current_user), response_model = FileUploadResponseBase):
+async def request_upload(current_user: dict = Depends(get_current_user), response_model = FileUploadResponseBase):
     """
     Request an upload link after a job is finished.
     """
-    return generate_upload_link(current_user)
+    return await generate_upload_link(current_user)
 
 
 @router.post("/upload/{token}")
@@ -131,24 +195,24 @@ async def upload_file(token: str,
                       session_id: str = Form(...), # A client-generated session ID. Used to verify that all chunks come from the same upload request.
                       chunk_index: int = Form(...), # The index of the current chunk, starts at 1
                       total_chunks: int = Form(...), # The total number of chunks
+                      chunk_sha256: Optional[str] = Form(None), # Optional SHA-256 hex digest of the chunk, to reject corrupted chunks
                       # Dependencies
-                      db: Session = Depends(get_db),
+                      db: AsyncSession = Depends(get_async_db),
                       current_user: dict = Depends(get_current_user)):
     """
     Securely upload a file in chunks using a one-time token.
-
-
-    Current problems with this implementation: no checks for the chunks arriving in the correct order. No checks for missing chunks. No file integrity checks. No checks that uploads all come from the same upload request (say the client has crashed). 
-    TODO: implement saving files to .tmp with chunk info and some unique identifier for the session. Then when all chunks are received, combine them into a single file and revoke the token. Q: should trust the client when it says "total 9 chunks" or how do we check the total number of chunks?
-
-
+    Chunks may arrive in any order. Every chunk but the last must be exactly chunk_size bytes long (see request-upload).
+    Uploads are resumable: the token stays valid while chunks keep arriving, chunks can be re-sent, and the missing chunks can be listed (see upload/{token}/missing).
+    Chunks of a session may be sent concurrently. Exactly one request, the first to see all chunks received, finalizes the file.
+    Chunks are hashed as they arrive. The file digest is computed from the chunk digests (see upload_manager.file_digest), stored with the file and returned.
+    Each chunk is written straight to its offset in a preallocated part file. Once all chunks are received, the part file is flushed and renamed.
     """
 
     print("Upload request received", flush=True)
     print("Checking token...", flush=True)
     
     # Step 1: Retrieve and validate the token from Redis
-    token_data = redis_client.get(token)
+    token_data = await async_redis_client.get(token)
     if not token_data:
         raise HTTPException(status_code=403, detail="Invalid or expired upload token")
 
@@ -159,121 +223,123 @@ async def upload_file(token: str,
     if user_id != current_user["sub"]:
         raise HTTPException(status_code=403, detail="Unauthorized user")
 
-    jb = db.query(Job).filter(Job.id == job_id).first()
+    jb = await db.get(Job, int(job_id))
     if not jb:
         raise HTTPException(status_code=404, detail="Job not found")
     print("Job found and user authorized", flush=True)
-
-    # Step 3: Check if token_info contains a file path and a session ID.
-    file_path = token_info.get("file_path", os.path.join(cfg.save_path, f"{uuid.uuid4()}.dat"))
-    token_session_id = token_info.get("session_id", session_id)
-    unique_id = token_info.get("unique_id", str(uuid.uuid4())[:8])
+    try:
+        file_type_enum = FileTypeEnum(file_type)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid file type: {file_type}")
+
+    # Step 3: Get the upload session of the token, started by its first chunk
+    if total_chunks < 1 or not 1 <= chunk_index <= total_chunks:
+        raise HTTPException(status_code=400, detail="Invalid chunk index")
+    if total_chunks * cfg.chunk_size > cfg.max_upload_size:
+        raise HTTPException(status_code=413, detail=f"File too large, uploads are limited to {cfg.max_upload_size} bytes")
+    session = await upload_manager.start_session(token, session_id, total_chunks, os.path.join(cfg.save_path, f"{uuid.uuid4()}.dat"), str(uuid.uuid4())[:8])
+    if not session:
+        raise HTTPException(status_code=403, detail="Invalid or expired upload token")
     # Handle session ID mismatch
-    if token_session_id != session_id:
-        # Invalidate token
-        redis_client.delete(token)
+    if session["session_id"] != session_id:
+        # Invalidate token, and remove what was written so far
+        await upload_manager.end_session(token)
         print("Session ID mismatch", flush=True)
         print(f"Invalidated token {token}", flush=True)
         raise HTTPException(status_code=403, detail="Session ID mismatch")
-    # Update redis
-    token_info["file_path"] = file_path
-    token_info["unique_id"] = unique_id
-    token_info["session_id"] = session_id
-
-    # Step 4: Get a tmp file path
-    os.makedirs(cfg.tmp_path, exist_ok=True)
-    tmp_file_path = os.path.join(cfg.tmp_path, f"{session_id}_{chunk_index}.tmp")
-    print(f"Temporary file path: {tmp_file_path}", flush=True)
-
-    # Step 5: Check that the file doesn't already exist, else invalidate and return an error
-    if os.path.isfile(tmp_file_path):
-        # Invalidate token
-        redis_client.delete(token)
-        print("File already exists", flush=True)
-        print(f"Invalidated token {token}", flush=True)
-        raise HTTPException(status_code=403, detail="File already exists. Upload session aborted.")
+    if session["total_chunks"] != total_chunks:
+        raise HTTPException(status_code=400, detail="Invalid number of chunks")
+    if session["finalized"]:
+        # The client missed the response of the finalizing request
+        return {"message": "Upload successful"}
+    file_path = session["file_path"]
+    unique_id = session["file_id"]
+    part_path = file_path + ".part"
+
+    # Step 4: Write the chunk at its offset in the part file, and record it in the upload session.
+    # Chunks already received are skipped: re-sending a chunk (e.g. after a dropped connection) is harmless.
+    # Once the upload is being finalized, all chunks are received and the part file is not written anymore.
+    write_id = None
+    if not await upload_manager.is_received(token, chunk_index):
+        write_id = await upload_manager.begin_write(token)
+    if write_id is None:
+        print(f"Chunk {chunk_index} already received", flush=True)
+    else:
+        chunk_data = await file.read()
+        if len(chunk_data) > cfg.chunk_size or (chunk_index < total_chunks and len(chunk_data) != cfg.chunk_size):
+            await upload_manager.end_write(token, write_id)
+            raise HTTPException(status_code=400, detail=f"Invalid chunk size, chunks must be {cfg.chunk_size} bytes long (except the last one)")
+        try:
+            os.makedirs(cfg.save_path, exist_ok=True)
+            digest = await asyncio.to_thread(write_chunk, part_path, (chunk_index - 1) * cfg.chunk_size, chunk_data, total_chunks * cfg.chunk_size, chunk_sha256)
+            print(f"Chunk {chunk_index}/{total_chunks} written to {part_path}", flush=True)
+        except ChunkDigestMismatch as e:
+            # Not recorded, the client re-sends the chunk
+            print(str(e), flush=True)
+            await upload_manager.end_write(token, write_id)
+            raise HTTPException(status_code=400, detail=str(e))
+        except Exception as e:
+            print(f"Error while writing the file: {str(e)}", flush=True)
+            await upload_manager.end_write(token, write_id)
+            raise HTTPException(status_code=500, detail=f"Upload failed: {str(e)}")
+        # Only recorded once written, so a recorded chunk is always on disk
+        received = await upload_manager.mark_received(token, chunk_index, len(chunk_data), digest, write_id)
+        if received < 0:
+            # The session ended while the chunk was written, which may have created the part file again
+            await asyncio.to_thread(remove_part_file, file_path)
+            raise HTTPException(status_code=403, detail="Invalid or expired upload token")
+        if received == 0:
+            # Another request wrote the same chunk in the meantime
+            print(f"Chunk {chunk_index} already received", flush=True)
+        else:
+            print(f"Chunks received: {received}/{total_chunks}", flush=True)
+
+    # Step 5: Once all chunks are received, exactly one request finalizes the file. A failed finalization is retried by the next request.
+    if not await upload_manager.claim_finalization(token):
+        print("Waiting for other chunks", flush=True)
+        return {"message": "Chunk received, waiting for other chunks"}
 
-    # Step 6: Write the chunk to the tmp file
+    print("All chunks received, finalizing...", flush=True)
     try:
-        async with aiofiles.open(tmp_file_path, "wb") as tmp_file:  # Open in write mode
-            print(f"Opened file {tmp_file_path} in write mode", flush=True)
-            
-            # Write the received chunk
-            chunk_data = await file.read()  # Read the current chunk of data
-            await tmp_file.write(chunk_data)  # Append the chunk to the file
-            print(f"Chunk {chunk_index}/{total_chunks} written to {tmp_file_path}", flush=True)
-
+        file_size = await upload_manager.file_size(token)
+        file_digest = await upload_manager.get_file_digest(token, total_chunks)
+        await asyncio.to_thread(finalize_part_file, part_path, file_path, file_size)
+        print(f"File written to {file_path}, digest {file_digest}", flush=True)
+
+        # Store file metadata in the database, and update the job entry with the file ID, in one transaction
+        if not await db.get(File, unique_id):
+            db.add(File(id=unique_id, type=file_type, full_path=file_path, digest=file_digest, chunk_size=cfg.chunk_size))
+        if file_type_enum == FileTypeEnum.kraus:
+            jb.kraus_operator = unique_id
+        elif file_type_enum == FileTypeEnum.vector:
+            jb.vector = unique_id
+        await db.commit()
+        print("DB entries committed for file and job", flush=True)
+
+        # The token cannot upload anything anymore, re-sent chunks are told the upload succeeded
+        await upload_manager.mark_finalized(token, file_path)
+        print("Upload marked as finalized", flush=True)
     except Exception as e:
-        print(f"Error while writing the file: {str(e)}", flush=True)
+        print(f"Error while finalizing the file: {str(e)}", flush=True)
+        await db.rollback()  # Undo changes if commit fails
+        await upload_manager.release_finalization(token)
         raise HTTPException(status_code=500, detail=f"Upload failed: {str(e)}")
 
-    # Step 7: Check that all chunks have been received
-    # look in the tmp folder for all chunks
-    tmp_files = os.listdir(cfg.tmp_path)
-    chunks = []
-    for file in tmp_files:
-        if session_id in file:
-            chunks.append(int(file.split("_")[-1].split(".")[0]))
-    chunks.sort()
-    print(f"Chunks received: {chunks}", flush=True)
-    # If all chunks have been received, combine them into a single file
-    if chunks == list(range(1, total_chunks + 1)):
-        print("All chunks received, combining...", flush=True)
-        try:
-            os.makedirs(cfg.save_path, exist_ok=True)
-            with open(file_path, "wb") as final_file:
-                for chunk in chunks:
-                    print(f"Combining chunk {chunk}...", flush=True)
-                    with open(os.path.join(cfg.tmp_path, f"{session_id}_{chunk}.tmp"), "rb") as tmp_file:
-                        final_file.write(tmp_file.read())
-            print("Chunks combined into a single file", flush=True)
-
-            # Delete the tmp files
-            print("Deleting temporary files...", flush=True)
-            for chunk in chunks:
-                os.remove(os.path.join(cfg.tmp_path, f"{session_id}_{chunk}.tmp"))
-
-            # Store file metadata in the database
-            new_file = File(id=unique_id, type=file_type, full_path=file_path)
-            db.add(new_file)
-            db.commit()
-            db.refresh(new_file)
-            print("DB entry created for file", flush=True)
-
-            # Step 6: Invalidate token after successful upload
-            redis_client.delete(token)
-            print("Token invalidated", flush=True)
-
-            # Step 7: Update the job entry with the file ID
-            try:
-                file_type_enum = FileTypeEnum(file_type)
-            except ValueError:
-                raise HTTPException(status_code=400, detail=f"Invalid file type: {file_type}")
-
-            if file_type_enum == FileTypeEnum.kraus:
-                jb.kraus_operator = unique_id
-            elif file_type_enum == FileTypeEnum.vector:
-                jb.vector = unique_id
-            
-            try:
-                db.commit()
-                db.refresh(jb)
-                print("Job entry committed to DB", flush=True)
-            except Exception as e:
-                db.rollback()  # Undo changes if commit fails
-                raise HTTPException(status_code=500, detail=f"Database update failed: {str(e)}")
-            
-            print("Upload successful", flush=True)
-            return {"message": "Upload successful"}
-
-
-
-            
+    print("Upload successful", flush=True)
+    return {"message": "Upload successful", "file_id": unique_id, "digest": file_digest}
 
-        except Exception as e:
-            print(f"Error while combining the chunks: {str(e)}", flush=True)
-            raise HTTPException(status_code=500, detail=f"Upload failed: {str(e)}")
 
-    else:
-        print("Waiting for other chunks", flush=True)
-        return {"message": "Chunk received, waiting for other chunks"}
+@router.get("/upload/{token}/missing")
+async def get_missing_chunks(token: str, current_user: dict = Depends(get_current_user)):
+    """
+    List the chunks of an upload that were not received yet, to resume an interrupted upload by sending only those.
+    """
+    token_data = await async_redis_client.get(token)
+    if not token_data:
+        raise HTTPException(status_code=403, detail="Invalid or expired upload token")
+    if json.loads(token_data)["user_id"] != current_user["sub"]:
+        raise HTTPException(status_code=403, detail="Unauthorized user")
+    missing = await upload_manager.missing_chunks(token)
+    if missing is None:
+        raise HTTPException(status_code=404, detail="Upload not started")
+    return missing
@@ -1,28 +1,46 @@
-from fastapi import APIRouter, Depends, HTTPException, Form, Body, Query
+from fastapi import APIRouter, Depends, HTTPException, Form, Body, Query, BackgroundTasks
 from sqlalchemy.orm import Session
 from app.core.security import get_current_user
-from app.db.base import get_db
-from app.schemas.job import JobBase, JobStatusModel, JobCreate, JobRequestModel
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.db.base import get_db, get_async_db
+from app.schemas.job import JobBase, JobStatusModel, JobCreate, JobRequestModel, JobPrioritize
 from app.models.job import JobStatus
 from app.models.user import User
+from typing import Optional
 
 from app.core.job_manager import job_manager
+from app.core.notifier import job_notifier
+import time
 
 
 router = APIRouter()
 
-@router.get("/status")
-def get_job_status(job_id = Query(...), current_user: dict = Depends(get_current_user), response_model = JobStatusModel, db: Session= Depends(get_db)):
-    # Check that the job is assigned to the user
-    j = job_manager.get_job_status(job_id)
+##########################
+# Job access dependencies
+##########################
+
+async def authorize_job(job_id, current_user: dict, db: AsyncSession) -> dict:
+    """Load the job snapshot with a single query and check that the job is assigned to the current user."""
+    j = await job_manager.get_job_snapshot_async(db, job_id)
     if not j:
         raise HTTPException(status_code=404, detail="Job not found.")
-    uid = job_manager.get_assigned_worker(job_id)
-    if not uid:
+    if not j["worker_id"]:
         raise HTTPException(status_code=404, detail="Job not assigned to any worker.")
-    if uid["id"] != current_user["sub"]:
+    if j["worker_id"] != current_user["sub"]:
         raise HTTPException(status_code=403, detail="Unauthorized user.")
-    
+    return j
+
+async def get_worker_job(job_id: str = Form(...), current_user: dict = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)) -> dict:
+    """Dependency returning the snapshot of the job given in the form, if it is assigned to the current user."""
+    return await authorize_job(job_id, current_user, db)
+
+async def get_worker_job_query(job_id: str = Query(...), current_user: dict = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)) -> dict:
+    """Dependency returning the snapshot of the job given in the query, if it is assigned to the current user."""
+    return await authorize_job(job_id, current_user, db)
+
+
+@router.get("/status")
+async def get_job_status(j: dict = Depends(get_worker_job_query), response_model = JobStatusModel):
     # user is authorized.
     return {
         "job_id": j["id"],
@@ -30,84 +48,62 @@ def get_job_status(job_id = Query(...), current_user: dict = Depends(get_current
     }
 
 @router.post("/ping")
-def ping(job_id = Form(...), current_user: dict = Depends(get_current_user), db: Session = Depends(get_db)):
-    # Update the last ping time for the worker
-
-    j = job_manager.ping_worker(current_user["sub"], job_id)
-    if not j:
+async def ping(job_id = Form(...), current_user: dict = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
+    # Update the last ping time for the worker. This is buffered in Redis and written to the database in batches.
+    if not await job_manager.record_progress_async(db, current_user["sub"], job_id, require_running=True):
         raise HTTPException(status_code=400, detail="Worker or job not found.")
-    j = db.merge(j)
     return {"message": "pong"}
 
 @router.get("/request")
-def request_job(current_user: dict = Depends(get_current_user), response_model = JobRequestModel, db: Session = Depends(get_db)):
+async def request_job(background_tasks: BackgroundTasks, wait: float = Query(0, ge=0, le=job_manager.config.job_request_max_wait), count: Optional[int] = Query(None, ge=1, le=job_manager.config.job_request_max_count), current_user: dict = Depends(get_current_user), response_model = JobRequestModel):
+    # If no job is available, wait up to `wait` seconds for one to be queued instead of returning immediately.
+    # With `count`, lease up to `count` jobs at once. The response is then a list of jobs.
     print("Requesting job for user:", current_user["sub"])
-    j = job_manager.assign_job_to_worker(current_user["sub"])
-    if not j:
-        print("No job available.")
-        raise HTTPException(status_code=204, detail="No job available.")
-    j = db.merge(j)
-    
+    deadline = time.monotonic() + wait
+    while True:
+        # Read the generation before trying, so that a job queued in the meantime is not missed
+        generation = job_notifier.generation
+        jobs, unconfirmed = await job_manager.claim_jobs_async(current_user["sub"], count or 1)
+        if jobs:
+            break
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            print("No job available.")
+            raise HTTPException(status_code=204, detail="No job available.")
+        await job_notifier.wait(generation, remaining)
+
+    # The jobs were claimed in Redis. Mark them as running in the database after responding.
+    background_tasks.add_task(job_manager.confirm_claims, current_user["sub"], unconfirmed)
+
     # If job is available, return all info about the job that the user might need to complete it. 
     # For example, kraus id and vector id.
-    # TODO: implement
-    print("Assigned job:", j)
-    return {
-        "job_id": j.id,
-        "job_type": j.job_type,
-        "job_data": j.input_data,
-        "job_status": j.status,
-        "kraus_id": j.kraus_operator,
-        "vector_id": j.vector,
-        "channel_id": j.channel_id
-    }
+    print("Assigned jobs:", jobs)
+    if count is None:
+        return jobs[0]
+    return {"jobs": jobs}
 
 @router.post("/pause")
-def pause_job(job_id: str = Form(...), current_user: dict = Depends(get_current_user), db: Session = Depends(get_db)):
-    # Check that the job is assigned to the user
-    j = job_manager.get_job_status(job_id)
-    if not j:
-        raise HTTPException(status_code=404, detail="Job not found.")
-    uid = job_manager.get_assigned_worker(job_id)
-    if not uid:
-        raise HTTPException(status_code=404, detail="Job not assigned to any worker.")
-    if uid["id"] != current_user["sub"]:
-        raise HTTPException(status_code=403, detail="Unauthorized user.")
-    
+async def pause_job(j: dict = Depends(get_worker_job), db: AsyncSession = Depends(get_async_db)):
     # user is authorized.
     # check that the job was running
     if j["status"] != "running":
         raise HTTPException(status_code=400, detail="Job is not running.")
     
     # mark the job as paused
-    j = job_manager.update_job_status(job_id, JobStatus.paused)
-    if not j:
+    if not await job_manager.update_job_status_async(db, j["id"], JobStatus.paused):
         raise HTTPException(status_code=400, detail="Job pausing failed.")
-    j = db.merge(j)
     return {"result": "success"}
 
 @router.post("/resume")
-def resume_job(job_id: str = Form(...), current_user: dict = Depends(get_current_user), db: Session = Depends(get_db)):
-    # Check that the job is assigned to the user
-    j = job_manager.get_job_status(job_id)
-    if not j:
-        raise HTTPException(status_code=404, detail="Job not found.")
-    uid = job_manager.get_assigned_worker(job_id)
-    if not uid:
-        raise HTTPException(status_code=404, detail="Job not assigned to any worker.")
-    if uid["id"] != current_user["sub"]:
-        raise HTTPException(status_code=403, detail="Unauthorized user.")
-    
+async def resume_job(j: dict = Depends(get_worker_job), db: AsyncSession = Depends(get_async_db)):
     # user is authorized.
     # check that the job was paused
     if j["status"] != "paused":
         raise HTTPException(status_code=400, detail="Job is not paused.")
     
     # mark the job as resumed
-    j = job_manager.update_job_status(job_id, JobStatus.running)
-    if not j:
+    if not await job_manager.update_job_status_async(db, j["id"], JobStatus.running):
         raise HTTPException(status_code=400, detail="Job resuming failed.")
-    j = db.merge(j)
     return {"result": "success"}
 
 @router.post("/create")
@@ -125,7 +121,7 @@ def create_job(job: JobCreate = Body(...), current_user: dict = Depends(get_curr
     print("Kraus operator:", job.kraus_operator)
     print("Vector:", job.vector)
     # Create a new job
-    j = job_manager.create_job(job.job_type, job.input_data, job.kraus_operator, job.vector)
+    j = job_manager.create_job(job.job_type, job.input_data, job.kraus_operator, job.vector, priority=job.priority)
     if not j:
         raise HTTPException(status_code=400, detail="Job creation failed.")
     j= db.merge(j)
@@ -137,59 +133,43 @@ def create_job(job: JobCreate = Body(...), current_user: dict = Depends(get_curr
     }
     return response
 
+@router.post("/prioritize")
+def prioritize_jobs(params: JobPrioritize = Body(...), current_user: dict = Depends(get_current_user), db: Session = Depends(get_db)):
+    # first check that the user is admin
+    db_user = db.query(User).filter(User.username == current_user["sub"]).first()
+    if not db_user or not db_user.role == "admin":
+        raise HTTPException(status_code=403, detail="Unauthorized user.")
+    if params.job_ids is None and params.channel_id is None:
+        raise HTTPException(status_code=400, detail="Specify job_ids and/or channel_id.")
+    # Re-rank the pending jobs in place
+    updated = job_manager.set_priority(params.priority, job_ids=params.job_ids, channel_id=params.channel_id)
+    return {"result": "success", "updated": len(updated)}
+
 @router.post("/update-iterations")
-def update_iterations(job_id: str = Form(...), num_iterations: int = Form(...), current_user: dict = Depends(get_current_user), db: Session = Depends(get_db)):
-    # Check that the job is assigned to the user
-    j = job_manager.get_job_status(job_id)
-    if not j:
+async def update_iterations(job_id: str = Form(...), num_iterations: int = Form(...), current_user: dict = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
+    # Check that the job is assigned to the user and update the number of iterations.
+    # This is buffered in Redis and written to the database in batches.
+    recorded = await job_manager.record_progress_async(db, current_user["sub"], job_id, num_iterations=num_iterations)
+    if recorded is None:
         raise HTTPException(status_code=404, detail="Job not found.")
-    uid = job_manager.get_assigned_worker(job_id)
-    if not uid["id"]:
-        raise HTTPException(status_code=404, detail="Job not assigned to any worker.")
-    if uid["id"] != current_user["sub"]:
+    if not recorded:
         raise HTTPException(status_code=403, detail="Unauthorized user.")
-    
-    # user is authorized.
-    # update the number of iterations
-    j = job_manager.update_iterations(job_id, num_iterations)
-    if not j:
-        raise HTTPException(status_code=400, detail="Job iteration update failed.")
-    j = db.merge(j)
     return {"result": "success"}
 
 @router.post("/update-entropy")
-def update_iterations(job_id: str = Form(...), entropy: float = Form(...), current_user: dict = Depends(get_current_user), db: Session = Depends(get_db)):
-    # Check that the job is assigned to the user
-    j = job_manager.get_job_status(job_id)
-    if not j:
+async def update_entropy(job_id: str = Form(...), entropy: float = Form(...), current_user: dict = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
+    # Check that the job is assigned to the user and update the entropy.
+    # This is buffered in Redis and written to the database in batches.
+    recorded = await job_manager.record_progress_async(db, current_user["sub"], job_id, entropy=entropy)
+    if recorded is None:
         raise HTTPException(status_code=404, detail="Job not found.")
-    uid = job_manager.get_assigned_worker(job_id)
-    if not uid["id"]:
-        raise HTTPException(status_code=404, detail="Job not assigned to any worker.")
-    if uid["id"] != current_user["sub"]:
+    if not recorded:
         raise HTTPException(status_code=403, detail="Unauthorized user.")
-    
-    # user is authorized.
-    # update the number of iterations
-    j = job_manager.update_entropy(job_id, entropy)
-    if not j:
-        raise HTTPException(status_code=400, detail="Job entropy update failed.")
-    j = db.merge(j)
     return {"result": "success"}
 
 
 @router.post("/complete")
-def complete_job(job_id: str = Form(...), current_user: dict = Depends(get_current_user), db: Session = Depends(get_db)):
-    # Check that the job is assigned to the user
-    j = job_manager.get_job_status(job_id)
-    if not j:
-        raise HTTPException(status_code=404, detail="Job not found.")
-    uid = job_manager.get_assigned_worker(job_id)
-    if not uid:
-        raise HTTPException(status_code=404, detail="Job not assigned to any worker.")
-    if uid["id"] != current_user["sub"]:
-        raise HTTPException(status_code=403, detail="Unauthorized user.")
-    
+async def complete_job(j: dict = Depends(get_worker_job), db: AsyncSession = Depends(get_async_db)):
     # user is authorized.
     # check that the job was running
     if j["status"] != "running":
@@ -197,59 +177,34 @@ def complete_job(job_id: str = Form(...), current_user: dict = Depends(get_curre
     
     # check that the user has uploaded the required files
     # if the job is create kraus, check that the kraus file is uploaded    
-    jtype = job_manager.get_job_type(job_id)
-    if not jtype:
-        raise HTTPException(status_code=404, detail="Job type not found.")
-
-    if jtype["job_type"] == "generate_kraus":
-        jkraus = job_manager.get_kraus_operator(job_id)
-        if not jkraus:
-            raise HTTPException(status_code=404, detail="Kraus operator not found.")
-        if not jkraus["kraus_operator"]:
-            raise HTTPException(status_code=400, detail="Kraus operator file not uploaded.")
+    if j["job_type"] == "generate_kraus" and not j["kraus_operator"]:
+        raise HTTPException(status_code=400, detail="Kraus operator file not uploaded.")
 
     # if the job is create vector, check that the vector file is uploaded
-    if jtype["job_type"] == "generate_vector":
-        jvector = job_manager.get_vector(job_id)
-        if not jvector:
-            raise HTTPException(status_code=404, detail="Vector not found.")
-        if not jvector["vector"]:
-            raise HTTPException(status_code=400, detail="Vector file not uploaded.")
+    if j["job_type"] == "generate_vector" and not j["vector"]:
+        raise HTTPException(status_code=400, detail="Vector file not uploaded.")
 
     # if the job type is minimize, both fields are populated from start. Don't do any checks
     # TODO : find some reasonable checks
 
     # mark the job as completed
-    j = job_manager.complete_job(job_id)
-    if not j:
+    if not await job_manager.complete_job_async(db, j["id"]):
         raise HTTPException(status_code=400, detail="Job completion failed.")
     return {"result": "success"}
 
 @router.post("/cancel")
-def cancel_job(job_id: str = Form(...), current_user: dict = Depends(get_current_user), db: Session = Depends(get_db)):
-    # Check that the job is assigned to the user
-    j = job_manager.get_job_status(job_id)
-    if not j:
-        raise HTTPException(status_code=404, detail="Job not found.")
-    uid = job_manager.get_assigned_worker(job_id)
-    if not uid:
-        raise HTTPException(status_code=404, detail="Job not assigned to any worker.")
-    if uid["id"] != current_user["sub"]:
-        raise HTTPException(status_code=403, detail="Unauthorized user.")
-    
+async def cancel_job(j: dict = Depends(get_worker_job), db: AsyncSession = Depends(get_async_db)):
     # user is authorized.
     # check that the job was running
     if j["status"] != "running" and j["status"] != "paused":
         print("Trying to cancel job that is not running or paused.")
         print("Job status:", j["status"])
-        print("Job id:", job_id)
+        print("Job id:", j["id"])
         raise HTTPException(status_code=400, detail="Job is not running or paused.")
     
     # mark the job as canceled
-    j = job_manager.update_job_status(job_id, JobStatus.canceled)
-    if not j:
+    if not await job_manager.update_job_status_async(db, j["id"], JobStatus.canceled):
         print("Job cancel failed.")
-        print("Job", j)
+        print("Job id:", j["id"])
         raise HTTPException(status_code=400, detail="Job cancel failed.")
     return {"result": "success"}
-
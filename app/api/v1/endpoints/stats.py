@@ -0,0 +1,14 @@
+from fastapi import APIRouter, Depends
+from app.core.security import get_current_user
+from app.db.base import engine, async_engine
+from app.db.pool import pool_stats
+
+router = APIRouter()
+
+@router.get("/db-pool")
+def get_db_pool_stats(current_user: dict = Depends(get_current_user)):
+    # Live statistics of the database connection pools of this process, to size them against real traffic.
+    return {
+        "sync": pool_stats(engine.pool),
+        "async": pool_stats(async_engine.sync_engine.pool),
+    }
@@ -1,28 +1,68 @@
 from sqlalchemy.orm import Session
+from sqlalchemy import select, update, or_, case, literal
 import redis
 from app.core.config import ChannelHandlingConfig
 from app.db.base import SessionFactory
 from functools import wraps
 from sqlalchemy.exc import IntegrityError, OperationalError, DataError, SQLAlchemyError
 from app.core.redis import redis_client
-from app.core.job_manager import job_manager
+from app.core.job_manager import job_manager, COMPLETIONS_STREAM, COMPLETIONS_GROUP, COMPLETIONS_DEAD_STREAM
+from app.core.leader import LeaderElection
+from app.core.notifier import SCHEDULER_EVENTS_CHANNEL
 from app.models.channel import Channel, ChannelStatusEnum
 from app.models.job import JobType, JobStatus, Job
-import asyncio
+import threading
+import time
+import datetime
+
+
+# Move the completions queued by older versions (in the to_process list) to the completions stream, atomically.
+# KEYS: legacy list, completions stream. Returns: number of moved completions.
+MIGRATE_COMPLETIONS_SCRIPT = """
+local moved = 0
+while true do
+    local job_id = redis.call('LPOP', KEYS[1])
+    if not job_id then
+        break
+    end
+    redis.call('XADD', KEYS[2], '*', 'job_id', job_id)
+    moved = moved + 1
+end
+return moved
+"""
 
 
 class ChannelManager:
     def __init__(self, redis_client: redis.Redis = redis_client, job_manager = job_manager, config: ChannelHandlingConfig = ChannelHandlingConfig()):
-        self.db = None
+        self._local = threading.local()
+        self.db = None # Database session, this is set using the _get_session method
         self.redis = redis_client
         self.config = config
         self.job_manager = job_manager
+        # The scheduler loop (see run) runs in its own thread, so that its synchronous database and Redis work never blocks the API event loop
+        self.thread = None
+        self._stop = threading.Event()
+        self._full_sync_done = False
+        # Scheduling must run exactly once across replicas, only the leader runs the loop
+        self.leader = LeaderElection(redis_client, "scheduler", ttl=config.leader_lease_ttl, renew_interval=config.leader_renew_interval)
+        # Completions are read from a stream by a consumer group, so every process can process them. The consumer name is the (unique) leader election owner.
+        self._migrate_completions = self.redis.register_script(MIGRATE_COMPLETIONS_SCRIPT)
+        self._completions_ready = False
 
     ############################
     # Session management methods
     ############################
 
 
+    @property
+    def db(self):
+        """Database session of the current thread. The scheduler thread and the API threads each get their own."""
+        return getattr(self._local, "db", None)
+
+    @db.setter
+    def db(self, session):
+        self._local.db = session
+
     def _get_session(self):
         """Get a new database session. Handle Exceptions"""
         try:
@@ -278,40 +318,24 @@ class ChannelManager:
         except:
             return False        
 
-    @ensure_session
-    def increase_runs_spawned(self, channel_id : str, n : int =1) -> bool:
-        """
-        Increase the number of runs spawned by n.
-        Returns: True if successful, False otherwise.
-        """
-        channel = self.db.query(Channel).filter(Channel.id == channel_id).first()
-        if not channel:
-            return False
-        # Try to update minimization attempts, if not possible, return False
-        try:
-            channel.runs_spawned = channel.runs_spawned + n
-            self.db.commit()
-            return True
-        except:
-            return False        
-
-    @ensure_session
-    def increase_runs_completed(self, channel_id : str, n : int =1) -> bool:
-        """
-        Increase the number of runs completed by n.
-        Returns: True if successful, False otherwise.
-        """
-        channel = self.db.query(Channel).filter(Channel.id == channel_id).first()
-        if not channel:
-            return False
-        # Try to update minimization attempts, if not possible, return False
-        try:
-            channel.runs_completed = channel.runs_completed + n
-            self.db.commit()
-            return True
-        except:
-            return False        
-
+    def _increase_runs_completed_statement(self, channel_id: int, n: int = 1):
+        """
+        Increase the number of runs completed by n, in a single UPDATE ... RETURNING. The channel is marked as completed in the same statement
+        once the number of runs completed reaches the number of minimization attempts.
+        """
+        return (
+            update(Channel)
+            .where(Channel.id == channel_id)
+            .values(
+                runs_completed=Channel.runs_completed + n,
+                status=case(
+                    (Channel.runs_completed + n >= Channel.minimization_attempts, literal(ChannelStatusEnum.completed, Channel.status.type)),
+                    else_=Channel.status,
+                ),
+            )
+            .returning(Channel.runs_completed, Channel.status)
+            .execution_options(synchronize_session=False)
+        )
 
     ######################
     #      Actions       #
@@ -329,6 +353,7 @@ class ChannelManager:
             self.db.add(new_channel)
             self.db.commit()
             self.db.refresh(new_channel)
+            self._notify_scheduler(f"channel:{new_channel.id}")
             return new_channel.id
         except:
             return None
@@ -346,13 +371,23 @@ class ChannelManager:
             self.db.add(new_channel)
             self.db.commit()
             self.db.refresh(new_channel)
+            self._notify_scheduler(f"channel:{new_channel.id}")
             return new_channel.id
         except:
             return None
         
-    def schedule_jobs(self) -> bool:
+    def _notify_scheduler(self, event: str):
+        """Wake up the scheduler (see run), e.g. to schedule the jobs of a new channel right away."""
+        try:
+            self.redis.publish(SCHEDULER_EVENTS_CHANNEL, event)
+        except redis.RedisError as e:
+            # The periodic tick picks it up
+            print(f"Failed to notify the scheduler: {e}")
+
+    def schedule_jobs(self, fence: tuple = None) -> bool:
         """
         Schedule jobs for all channels. Connect to database and schedule jobs for all channels.
+        If a fence is given (see LeaderElection.fence), no job is created once a newer leader was elected.
         Returns: True if successful, False otherwise.
         """
         print("Scheduling jobs for all channels...")
@@ -361,17 +396,24 @@ class ChannelManager:
         # Get all channels
         channels = session.query(Channel).all()
 
+        # Vector jobs to spawn for minimizing channels, and the number of runs spawned per channel
+        specs = []
+        runs_spawned = {}
+
         # Schedule jobs for all channels
         for channel in channels:
             # If the channel is generating, schedule the corresponding generating job if not already done
             if channel.status == ChannelStatusEnum.created:
+                if fence and not self.job_manager.fence_holds(fence):
+                    print("A newer scheduler leader was elected. Stopping scheduling.")
+                    break
                 # Step 1: schedule job for creating Kraus operator
                 # TODO: implement different instructions for different types of channels? This should be stored in the channel info, and the job manager should also be updated
                 # Get dimensions and number of kraus
                 print("Trying to generate kraus operators for channel ", channel.id)
                 data = {"input_dimension": channel.input_dimension, "output_dimension": channel.output_dimension, "number_kraus": channel.num_kraus, "channel_id": channel.id}
                 print("Data: ", data)
-                j = self.job_manager.create_job(job_type=JobType.generate_kraus, input_data=data, channel_id = channel.id)
+                j = self.job_manager.create_job(job_type=JobType.generate_kraus, input_data=data, channel_id = channel.id, priority=self.config.kraus_job_priority)
                 print("Job created: ", j)
                 if not j:
                     print("Error while creating a job for generating kraus operators...")
@@ -393,68 +435,49 @@ class ChannelManager:
                         # There is space for spawning more!
                         jobs_to_spawn = channel.minimization_attempts - channel.runs_spawned
                         print(f"Need to spawn {jobs_to_spawn} more jobs for channel {channel.id}")
-                        for i in range(min(jobs_to_spawn, self.config.channel_max_jobs)):
-                            # Spawn a new minimizing job. This really is a job for creating a new vector...
-                            data = {"input_dimension": channel.input_dimension, "channel_id": channel.id}
-                            j = self.job_manager.create_job(job_type=JobType.generate_vector, input_data=data, channel_id = channel.id)
-                            if not j:
-                                # Something happened, break the loop. Job hasn't spawned so don't increase number of jobs
-                                print("Failed to create a generate_vector job...")
-                            # Increase the number of spawned runs by 1. THIS DOES NOT CHANGE THE CHANNEL, JUST THE ROW IN THE DB!!!
-                            if not self.increase_runs_spawned(channel.id, 1):
-                                print("Could not increase number of runs spawned, may end up running the algorithm too mnany times...")
-                            print(f"Scheduled job for generating a vector for channel {channel.id}...")
+                        n = min(jobs_to_spawn, self.config.channel_max_jobs)
+                        # Spawn new minimizing jobs. These really are jobs for creating a new vector...
+                        data = {"input_dimension": channel.input_dimension, "channel_id": channel.id}
+                        specs.extend({"job_type": JobType.generate_vector, "input_data": data, "channel_id": channel.id, "priority": self.config.vector_job_priority} for _ in range(n))
+                        runs_spawned[channel.id] = n
                 continue
         # clean up session
         session.close()
 
-        return True
-    
-    def update_MOE(self):
-        """
-        Update the best MOE for all channels. Connect to database and update the best MOE for all channels.
-        Returns: True if successful, False otherwise.
-        """
-        print("Updating MOE for all channels...")
-        session = self._get_session()
-        # Get all channels
-        channels = session.query(Channel).all()
-        if not channels:
-            return False
-        # Update MOE for all channels
-        for channel in channels:
-            # If the channel is minimizing (or is done), update the best MOE
-            if channel.status == ChannelStatusEnum.minimizing or channel.status == ChannelStatusEnum.completed:
-                # Get all jobs that this channel has spawned.
-                jobs = session.query(Job).filter(Job.channel_id == channel.id).all()
-                if not jobs:
-                    print("No jobs found for channel ", channel.id)
-
-                # Loop through all jobs and get the MOE
-                for job in jobs:
-                    # If the job is a minimization job, get its current entropy
-                    if JobType(job.job_type) == JobType.minimize and job.status == JobStatus.completed:
-
-                        # Get the entropy from the job
-                        entropy = job.entropy
-                        # If the entropy is less than the current MOE, update the entropy in the channel
-                        # and update the vector. Do so only if the entropy is positive.
-                        if (entropy < self.get_best_moe(channel.id) and entropy >= 0) or self.get_best_moe(channel.id) < 0:
-                            # Update the best MOE
-                            print(f"Channel {channel.id} has new best MOE: {entropy}. Updating the best MOE...")
-                            if not self.set_best_moe(channel.id, entropy):
-                                print("Error updating the best MOE...")
-                                return False
-                            # Update the vector ID
-                            if not self.set_vector_id(channel.id, job.vector):
-                                print("Error updating the best vector ID...")
-                                return False
-        print("Updated MOE for all channels...")
-
+        # Create all the vector jobs at once. The runs spawned are increased in the same transaction.
+        if specs:
+            try:
+                if self.job_manager.create_jobs_bulk(specs, runs_spawned=runs_spawned, fence=fence):
+                    print(f"Scheduled {len(specs)} jobs for generating vectors for channels {list(runs_spawned)}...")
+            except Exception as e:
+                print(f"Failed to create generate_vector jobs: {e}")
+                return False
 
-        # clean up session
-        session.close()                
         return True
+    
+    @ensure_session
+    def backfill_best_moe(self) -> int:
+        """
+        Recompute the best MOE of all channels from their completed minimization jobs, in a single UPDATE.
+        The best MOE is kept up to date as minimizations complete (see _process_completed_batch), this only recovers from missed updates.
+        Returns: number of channels updated.
+        """
+        best = (
+            select(Job.channel_id, Job.entropy, Job.vector)
+            .where(Job.job_type == JobType.minimize, Job.status == JobStatus.completed, Job.entropy >= 0, Job.channel_id.is_not(None))
+            .distinct(Job.channel_id)
+            .order_by(Job.channel_id, Job.entropy.asc())
+            .subquery("best")
+        )
+        updated = self.db.execute(
+            update(Channel)
+            .where(Channel.id == best.c.channel_id, or_(Channel.best_moe < 0, Channel.best_moe > best.c.entropy))
+            .values(best_moe=best.c.entropy, best_entropy_vector_id=best.c.vector)
+            .returning(Channel.id)
+        ).all()
+        self.db.commit()
+        print(f"Backfilled the best MOE of {len(updated)} channels.")
+        return len(updated)
 
     def process_completed_jobs(self):
         """
@@ -462,131 +485,339 @@ class ChannelManager:
         1) If kraus creation is finished, update the channel with the kraus ID and set the status to minimizing.
         2) If minimization is happening:
             - If the completed job is a vector creation job, spawn a new minimization job with that vector.
-            - If the completed job is a minimization job, update the best MOE and increment the number of runs completed.
+            - If the completed job is a minimization job, increment the number of runs completed and update the best MOE if it improved.
             - If the number of runs completed is equal to the number of minimization attempts, set the channel status to completed.
+        Completions are read from the completions stream as a consumer group, in batches of completed_batch_size, and acknowledged once processed.
+        Several processes can consume them in parallel. A completion is delivered at least once, and processed only once (see _process_completed_batch).
+        Completions that keep failing stay pending and are retried on the next calls, without holding back the others,
+        until they are moved to the dead-letter stream after completed_max_deliveries deliveries.
+        Returns: True if successful, False otherwise.
         """           
         print("Processing completed jobs...")
-        # Step 1: obtain all jobs in the redis queue
-        while (jid := self.redis.lpop("to_process")) is not None:
-            try:
-                jid = int(jid)
-            except ValueError:
-                print("Error parsing job ID from redis queue...")
-                continue
-            # Get the job from the database
-            type = self.job_manager.get_job_type(jid)
-            if type:
-                type = type["job_type"]
-            else:
-                print("Was trying to process completed job, but I found no job type for id ", jid)
-            # Step 3: consider the various cases.
-            if JobType(type) == JobType.generate_kraus:
-                # Case 1. Job finished is generate_kraus. 
-                #       -> Update the kraus info in the channel, and set the channel status to minimizing
-                # Get the kraus ID from the job
-                kraus_id = self.job_manager.get_kraus(jid)
-                if kraus_id:
-                    kraus_id = kraus_id["kraus_operator"]
-                else:
-                    print("Was trying to process completed job, but I found no kraus id for id ", jid)
-                # Get the channel ID from the job
-                channel_id = self.job_manager.get_channel(jid)
-                if not channel_id:
-                    print("Was trying to process completed job, but I found no channel id for id ", jid)
-                try:
-                    channel_id = channel_id["channel_id"]
-                except:
-                    print("Was trying to process completed job, but I found no channel id for id ", jid)
-
-                # Update the channel with the kraus ID
-                if not self.set_kraus_id(channel_id, kraus_id):
-                    print("Error updating the channel with the kraus ID...")
-                    print("Will reset the channel status to created, to reschedule creation job.")
-                    self.set_channel_status(channel_id, ChannelStatusEnum.created)
-                # Set the channel status to minimizing
-                self.set_channel_status(channel_id, ChannelStatusEnum.minimizing)
-
-            elif JobType(type) == JobType.generate_vector:
-                # Case 2. Job finished is generate_vector.
-                #       -> Spawn a new job of type "minimize" for that vector
-                # Runs have already been increased
-                # Get the vector ID from the job
-                vector_id = self.job_manager.get_vector(jid)
-                if vector_id:
-                    vector_id = vector_id["vector"]
-                else:
-                    print("Was trying to process completed job, but I found no vector id for id ", jid)
-                # Get the channel ID from the job
-                channel_id = self.job_manager.get_channel(jid)
-                if not channel_id:
-                    print("Was trying to process completed job, but I found no channel id for id ", jid)
-                try:
-                    channel_id = channel_id["channel_id"]
-                except:
-                    print("Was trying to process completed job, but I found no channel id for id ", jid)
-                # Get kraus ID
-                kraus_id = self.get_kraus_id(channel_id)
-                if not kraus_id:
-                    print("Was trying to process completed job, but I found no kraus id for channel ", channel_id)
-                
-                # Spawn a new job of type minimize
-                print("Spawning a new job for minimizing...")
-                print("Passed parameters")
-                print("Vector ID: ", vector_id)
-                print("Channel ID: ", channel_id)
-                print("Vector ID: ", vector_id)
-                print("Kraus ID: ", kraus_id)
-
-                data = {"input_dimension": self.get_channel_dimensions(channel_id)[0], "output_dimension": self.get_channel_dimensions(channel_id)[1], "number_kraus": self.get_num_kraus(channel_id), "channel_id": channel_id}
-                j = self.job_manager.create_job(job_type=JobType.minimize, input_data=data, vector=vector_id, kraus_operators=kraus_id, channel_id = channel_id)
-                if not j:
-                    print("Error creating a new job for minimizing...")
-
-            elif JobType(type) == JobType.minimize:
-                # Case 3. Job finished is minimize.
-                #       -> Increase runs_completed by 1
-                #       -> If runs_completed == minimization_attempts, set channel status to completed.
-                # Get the channel ID from the job
-                channel_id = self.job_manager.get_channel(jid)
-                if not channel_id:
-                    print("Was trying to process completed job, but I found no channel id for id ", jid)
-                try:
-                    channel_id = channel_id["channel_id"]
-                except:
-                    print("Was trying to process completed job, but I found no channel id for id ", jid)
-                # Increase the number of runs completed
-                if not self.increase_runs_completed(channel_id):
-                    print("Error increasing the number of runs completed...")
-                # Check if we have reached the number of minimization attempts
-                if self.get_runs_completed(channel_id) == self.get_minimization_attempts(channel_id):
-                    # Set the channel status to completed
-                    self.set_channel_status(channel_id, ChannelStatusEnum.completed)
-                    print(f"Channel {channel_id} has completed minimization.")
-        return True
-    
-    async def update(self):
-        while True:
-            try:
-                # Schedule jobs if needed
-                if not self.schedule_jobs():
-                    print("Error scheduling jobs...")
-                
-                # Process completed jobs
-                if not self.process_completed_jobs():
-                    print("Error processing completed jobs...")
+        success = True
+        try:
+            self._ensure_completions_stream()
+            # Step 1: completions this process read before but did not acknowledge (e.g. a failed batch). Failed ones are skipped until the next call.
+            start = "0"
+            while (entries := self._read_completions(start)):
+                success &= self._process_completions(entries, redelivered=True)
+                start = entries[-1][0]
+            # Step 2: completions left unacknowledged by other processes for too long (e.g. they crashed)
+            cursor = "0-0"
+            while True:
+                cursor, entries = self._claim_abandoned_completions(cursor)
+                if entries:
+                    success &= self._process_completions(entries, redelivered=True)
+                if cursor in ("0-0", b"0-0"):
+                    break
+            # Step 3: new completions. A failed batch stays pending and is retried by step 1 of the next call.
+            while (entries := self._read_completions(">")):
+                if not self._process_completions(entries):
+                    success = False
+                    break
+        except Exception as e:
+            print(f"Error while processing completed jobs: {e}")
+            return False
+        return success
 
-                # Update MOE
-                if not self.update_MOE():
-                    print("Error updating MOE...")
+    def _ensure_completions_stream(self):
+        """Create the completions stream and its consumer group, and move the completions queued by older versions to it. Once per process."""
+        if self._completions_ready:
+            return
+        try:
+            self.redis.xgroup_create(COMPLETIONS_STREAM, COMPLETIONS_GROUP, id="0", mkstream=True)
+        except redis.ResponseError as e:
+            # The group already exists
+            if "BUSYGROUP" not in str(e):
+                raise
+        moved = self._migrate_completions(keys=["to_process", COMPLETIONS_STREAM])
+        if moved:
+            print(f"Moved {moved} completed jobs from the to_process list to the completions stream.")
+        self._completions_ready = True
+
+    def _read_completions(self, start: str) -> list:
+        """Read a batch of completions: ">" for new ones, "0" for the ones already delivered to this process but not acknowledged."""
+        streams = self.redis.xreadgroup(COMPLETIONS_GROUP, self.leader.owner, {COMPLETIONS_STREAM: start}, count=self.config.completed_batch_size)
+        return streams[0][1] if streams else []
 
-                # Make sure the job manager manages jobs
-                self.job_manager.manage_jobs()
+    def _claim_abandoned_completions(self, cursor: str):
+        """
+        Take over a batch of completions that other processes did not acknowledge in time.
+        Returns: cursor to continue from ("0-0" when done), list of claimed completions.
+        """
+        result = self.redis.xautoclaim(COMPLETIONS_STREAM, COMPLETIONS_GROUP, self.leader.owner, self.config.completed_claim_idle * 1000, start_id=cursor, count=self.config.completed_batch_size)
+        return result[0], result[1]
 
+    def _process_completions(self, entries: list, redelivered: bool = False) -> bool:
+        """
+        Process a batch of completions read from the stream, then acknowledge and delete them.
+        If the batch fails, its completions are processed one by one, so that a single bad completion does not hold back the others.
+        Redelivered completions are checked against completed_max_deliveries first (see _dead_letter_completions).
+        Returns: True if all completions were processed, False if some failed (they stay pending).
+        """
+        if redelivered:
+            entries = self._dead_letter_completions(entries)
+        if not entries:
+            return True
+        try:
+            self._process_and_acknowledge(entries)
+            return True
+        except Exception as e:
+            print(f"Error while processing a batch of {len(entries)} completions: {e}")
+        if len(entries) == 1:
+            return False
+        failed = 0
+        for entry in entries:
+            try:
+                self._process_and_acknowledge([entry])
             except Exception as e:
-                print(f"Exception in update(): {e}")
+                print(f"Error while processing completion {entry[0]}: {e}")
+                failed += 1
+        return failed == 0
+
+    def _dead_letter_completions(self, entries: list) -> list:
+        """
+        Move the completions delivered completed_max_deliveries times or more to the dead-letter stream, then acknowledge and delete them.
+        Returns: the other completions.
+        """
+        # Look up each entry on its own: claimed entries may interleave with other pending entries of this process, so an ID range would not match the batch
+        pipe = self.redis.pipeline(transaction=False)
+        for entry_id, _ in entries:
+            pipe.xpending_range(COMPLETIONS_STREAM, COMPLETIONS_GROUP, min=entry_id, max=entry_id, count=1)
+        deliveries = {pending[0]["message_id"]: pending[0]["times_delivered"] for pending in pipe.execute() if pending}
+        dead = [(entry_id, fields) for entry_id, fields in entries if deliveries.get(entry_id, 0) >= self.config.completed_max_deliveries]
+        if not dead:
+            return entries
+        entry_ids = [entry_id for entry_id, _ in dead]
+        pipe = self.redis.pipeline()
+        for entry_id, fields in dead:
+            pipe.xadd(COMPLETIONS_DEAD_STREAM, {**(fields or {}), "entry_id": entry_id, "deliveries": deliveries[entry_id]})
+        pipe.xack(COMPLETIONS_STREAM, COMPLETIONS_GROUP, *entry_ids)
+        pipe.xdel(COMPLETIONS_STREAM, *entry_ids)
+        pipe.execute()
+        print(f"Moved {len(dead)} completions to {COMPLETIONS_DEAD_STREAM} after {self.config.completed_max_deliveries} failed deliveries: {entry_ids}")
+        dead_ids = set(entry_ids)
+        return [entry for entry in entries if entry[0] not in dead_ids]
+
+    def _process_and_acknowledge(self, entries: list):
+        """Process a batch of completions in one transaction, then acknowledge and delete them."""
+        job_ids = []
+        for _, fields in entries:
+            try:
+                job_ids.append(int(fields[b"job_id"]))
+            except (TypeError, KeyError, ValueError):
+                # Missing (deleted) or invalid entry, acknowledge it anyway
+                print("Error parsing job ID from the completions stream...")
+        self._process_completed_batch(job_ids)
+        # Acknowledge only once the batch is committed. If this process dies before, the batch is delivered again, and the jobs already processed are skipped.
+        entry_ids = [entry_id for entry_id, _ in entries]
+        pipe = self.redis.pipeline()
+        pipe.xack(COMPLETIONS_STREAM, COMPLETIONS_GROUP, *entry_ids)
+        pipe.xdel(COMPLETIONS_STREAM, *entry_ids)
+        pipe.execute()
+
+    def _process_completed_batch(self, job_ids: list):
+        """
+        Process a batch of completed jobs: load the jobs and their channels with one query each, apply all the transitions in memory, and commit once.
+        Loading the jobs marks them as processed, in the same transaction. Jobs already processed (e.g. delivered twice) are skipped.
+        The channels are locked until the commit, so the transitions can be applied in memory without racing with other processes.
+        The runs completed are increased, and the channel status flipped to completed, by a single UPDATE per channel (see _increase_runs_completed_statement).
+        The minimization jobs spawned for completed vector jobs are inserted in the same transaction, and queued after the commit.
+        """
+        if not job_ids:
+            return
+        session = self._get_session()
+        try:
+            # Step 2: load the jobs not processed yet, marking them as processed, and their channels
+            jobs = session.execute(
+                update(Job)
+                .where(Job.id.in_(job_ids), Job.status == JobStatus.completed, Job.time_processed.is_(None))
+                .values(time_processed=datetime.datetime.now())
+                .returning(Job.id, Job.job_type, Job.kraus_operator, Job.vector, Job.entropy, Job.channel_id)
+                .execution_options(synchronize_session=False)
+            ).all()
+            skipped = set(job_ids) - {job.id for job in jobs}
+            if skipped:
+                print(f"Skipping jobs {sorted(skipped)}: not found, not completed or already processed.")
+            channel_ids = {job.channel_id for job in jobs if job.channel_id is not None}
+            # Lock in a fixed order, so that concurrent batches cannot deadlock
+            channels = {channel.id: channel for channel in session.query(Channel).filter(Channel.id.in_(channel_ids)).order_by(Channel.id).with_for_update().all()}
+
+            # Step 3: consider the various cases.
+            specs = []
+            runs_completed = {}  # Minimizations completed per channel, counted in SQL once the other transitions are flushed
+            for job in sorted(jobs, key=lambda job: job.id):
+                channel = channels.get(job.channel_id)
+                if not channel:
+                    print("Was trying to process completed job, but I found no channel for id ", job.id)
+                    continue
+                job_type = JobType(job.job_type)
+                if job_type == JobType.generate_kraus:
+                    # Case 1. Job finished is generate_kraus.
+                    #       -> Update the kraus info in the channel, and set the channel status to minimizing
+                    if not job.kraus_operator:
+                        print("Was trying to process completed job, but I found no kraus id for id ", job.id)
+                        print("Will reset the channel status to created, to reschedule creation job.")
+                        channel.status = ChannelStatusEnum.created
+                        continue
+                    channel.kraus_id = job.kraus_operator
+                    channel.status = ChannelStatusEnum.minimizing
+
+                elif job_type == JobType.generate_vector:
+                    # Case 2. Job finished is generate_vector.
+                    #       -> Spawn a new job of type "minimize" for that vector
+                    # Runs have already been increased
+                    if not job.vector:
+                        print("Was trying to process completed job, but I found no vector id for id ", job.id)
+                    if not channel.kraus_id:
+                        print("Was trying to process completed job, but I found no kraus id for channel ", channel.id)
+                    data = {"input_dimension": channel.input_dimension, "output_dimension": channel.output_dimension, "number_kraus": channel.num_kraus, "channel_id": channel.id}
+                    specs.append({"job_type": JobType.minimize, "input_data": data, "vector": job.vector, "kraus_operators": channel.kraus_id, "channel_id": channel.id, "priority": self.config.minimize_job_priority})
+
+                elif job_type == JobType.minimize:
+                    # Case 3. Job finished is minimize.
+                    #       -> Increase runs_completed by 1 (below, once per channel)
+                    #       -> Keep the best MOE of the channel up to date. Negative entropies mean the job did not report one.
+                    #       -> If runs_completed == minimization_attempts, set channel status to completed.
+                    runs_completed[channel.id] = runs_completed.get(channel.id, 0) + 1
+                    if job.entropy is not None and job.entropy >= 0 and (channel.best_moe < 0 or job.entropy < channel.best_moe):
+                        print(f"Channel {channel.id} has new best MOE: {job.entropy}.")
+                        channel.best_moe = job.entropy
+                        channel.best_entropy_vector_id = job.vector
+
+            # Increase the runs completed, and flip the status of the channels that are done, in one statement per channel on top of the transitions above
+            session.flush()
+            for channel_id, n in runs_completed.items():
+                row = session.execute(self._increase_runs_completed_statement(channel_id, n)).first()
+                if row and ChannelStatusEnum(row.status) == ChannelStatusEnum.completed and channels[channel_id].status != ChannelStatusEnum.completed:
+                    print(f"Channel {channel_id} has completed minimization.")
 
-            # Sleep for a while
-            await asyncio.sleep(self.config.update_interval)
+            # Spawn the new minimization jobs in the same transaction
+            spawned = self.job_manager.insert_jobs(session, specs)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+        # Queue the new jobs once they are committed
+        self.job_manager._enqueue_jobs(spawned)
+        print(f"Processed {len(jobs)} completed jobs, spawned {len(spawned)} minimization jobs.")
+
+    def update(self, full: bool = True):
+        """
+        One scheduler tick: sync the queue, schedule and process jobs, and let the job manager manage jobs.
+        Ticks triggered by an event (full=False) only move the channels forward: process the completed jobs and schedule the next ones.
+        """
+        # Leader-only writes are fenced with the token of the leadership the tick started with
+        fence = self.leader.fence
+        if not fence:
+            print("Not the leader, skipping the tick.")
+            return
+        if full:
+            # Rebuild the job queue from the database once, then only catch up with the recently updated jobs.
+            # Likewise, recover the best MOEs once, they are then updated as minimizations complete.
+            if not self._full_sync_done:
+                self.backfill_best_moe()
+            self.job_manager.sync_jobs(incremental=self._full_sync_done, fence=fence)
+            self._full_sync_done = True
+
+        # The leadership may have been lost during a long sync. Never spawn jobs without it.
+        if not self.leader.is_leader:
+            print("Lost leadership during the tick, skipping scheduling.")
+            return
+
+        # Process completed jobs first, they may let channels spawn new jobs right away. This also updates the best MOEs.
+        if not self.process_completed_jobs():
+            print("Error processing completed jobs...")
+
+        # Schedule jobs if needed
+        if not self.schedule_jobs(fence=fence):
+            print("Error scheduling jobs...")
+
+        if full:
+            # Make sure the job manager manages jobs
+            self.job_manager.manage_jobs(fence=fence)
+
+    def _wait_for_event(self, pubsub, stop: threading.Event, timeout: float) -> bool:
+        """
+        Wait up to timeout seconds for a scheduler event, or for the stop event.
+        Returns: True if woken up by a scheduler event, False otherwise.
+        """
+        deadline = time.monotonic() + timeout
+        while not stop.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            try:
+                if not pubsub.subscribed:
+                    pubsub.subscribe(SCHEDULER_EVENTS_CHANNEL)
+                message = pubsub.get_message(ignore_subscribe_messages=True, timeout=min(remaining, self.config.event_poll_interval))
+                if message:
+                    # Coalesce a burst of events (e.g. many jobs completing at once) into a single tick
+                    for _ in range(1000):
+                        if not pubsub.get_message(ignore_subscribe_messages=True, timeout=0):
+                            break
+                    return True
+            except redis.RedisError as e:
+                # Events are lost while disconnected, the periodic tick catches up
+                print(f"Error while waiting for scheduler events: {e}")
+                pubsub.reset()
+                stop.wait(min(remaining, self.config.event_poll_interval))
+        return False
+
+    def run(self, stop: threading.Event = None):
+        """
+        Run the scheduler loop until the stop event is set. Blocking, run it in a thread (see start) or in its own process (app.scheduler).
+        Every process campaigns for leadership, only the leader runs the ticks. The others only process completed jobs.
+        The loop wakes up on scheduler events (e.g. a completed job), with a full tick every update_interval seconds as a fallback.
+        """
+        stop = stop or self._stop
+        self.leader.start()
+        pubsub = self.redis.pubsub()
+        next_full_tick = time.monotonic()
+        event = False
+        try:
+            while not stop.is_set():
+                if self.leader.is_leader:
+                    full = not event or time.monotonic() >= next_full_tick
+                    try:
+                        self.update(full=full)
+                    except Exception as e:
+                        print(f"Exception in update(): {e}")
+                    if full:
+                        next_full_tick = time.monotonic() + self.config.update_interval
+                    timeout = max(0, next_full_tick - time.monotonic())
+                else:
+                    # Completions are processed by every process, only the scheduling is reserved to the leader
+                    if not self.process_completed_jobs():
+                        print("Error processing completed jobs...")
+                    # The previous leader may have changed the queue, rebuild it from scratch once leader again
+                    self._full_sync_done = False
+                    next_full_tick = time.monotonic()
+                    timeout = self.config.leader_renew_interval
+
+                # Wait for an event or the next full tick, waking up early on stop
+                event = self._wait_for_event(pubsub, stop, timeout)
+        finally:
+            pubsub.close()
+            self.leader.stop(self.config.leader_renew_interval)
+        print("Scheduler stopped.")
+
+    def start(self):
+        """Start the scheduler loop in a background thread."""
+        if self.thread and self.thread.is_alive():
+            return
+        self._stop.clear()
+        self.thread = threading.Thread(target=self.run, args=(self._stop,), name="channel-scheduler", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout: float = None):
+        """Stop the scheduler thread, waiting up to timeout seconds for the current tick to finish."""
+        self._stop.set()
+        if self.thread:
+            self.thread.join(timeout)
+            self.thread = None
             
 
 
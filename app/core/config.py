@@ -1,18 +1,26 @@
 # dataclass for configuration
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+import os
 
 @dataclass
 class JobManagerConfig:
     job_paused_ttl: int = 60 * 60 * 24  # 1 day
     job_running_ttl: int = 60 * 60 * 24 * 30  # 30 days
     job_ping_ttl: int = 60 * 5  # 5 minutes, how often workers need to ping the server
+    job_claim_lease_ttl: int = 60 * 2  # 2 minutes, how long a claimed job may stay unconfirmed before it is put back in the queue. Keep it well above DatabaseConfig.pool_timeout, the confirmation may wait that long for a connection
+    job_request_max_wait: int = 60  # 1 minute, longest time a job request may wait for a job to be queued
+    job_request_max_count: int = 128  # Most jobs a worker may lease in a single request
+    job_sync_overlap: int = 60  # 1 minute, how far before the last sync an incremental sync starts looking for updated jobs
+    job_hot_flush_batch: int = 1000  # Most buffered job updates written to the database in a single statement
 
 @dataclass
 class FileHandlingConfig:
     download_link_ttl: int = 60 * 5  # 5 minutes
-    upload_link_ttl: int = 60 * 5  # 5 minutes
+    upload_link_ttl: int = 60 * 5  # 5 minutes. Extended every time a chunk arrives, so it only expires idle uploads.
+    upload_finalize_timeout: int = 60 * 5  # 5 minutes, after which another request may finalize an upload if the finalizer did not finish
 
     chunk_size: int = 1024 * 1024  # 1 MB
+    max_upload_size: int = 1024 * 1024 * 1024 * 10  # 10 GB, largest file that may be uploaded (the part file is preallocated to total_chunks * chunk_size)
 
     save_path = "/data"  # Where files are stored
     tmp_path = "/tmp"  # Where files are temporarily stored
@@ -21,5 +29,40 @@ class FileHandlingConfig:
 class ChannelHandlingConfig:
     channel_number_of_runs: int = 100
     channel_max_jobs: int = 5
-    update_interval: int = 5  # 5 seconds
+    update_interval: int = 30  # 30 seconds. The scheduler wakes up on events (completed jobs, new channels), this periodic tick is a fallback.
+    event_poll_interval: float = 1  # 1 second, how often the scheduler checks for a stop request while it waits for events
+    completed_batch_size: int = 500  # Most completed jobs processed in a single transaction
+    completed_claim_idle: int = 60  # 1 minute, completions left unacknowledged this long (e.g. by a crashed process) are taken over by another one
+    completed_max_deliveries: int = 10  # Completions delivered this many times without being processed are moved to the dead-letter stream
+    # Run the scheduler in a thread of the API process. Set SCHEDULER_IN_API=0 when it runs as its own process (python -m app.scheduler).
+    scheduler_in_api: bool = field(default_factory=lambda: os.environ.get("SCHEDULER_IN_API", "1") != "0")
+    # Only one scheduler runs across all processes and replicas: the leader, elected on a Redis lock
+    leader_lease_ttl: int = 15  # 15 seconds, another process takes over if the leader does not renew its lease in time
+    leader_renew_interval: int = 5  # 5 seconds
+    # Priorities of the jobs spawned for channels (higher is assigned first). Finishing channels beats starting new runs.
+    kraus_job_priority: int = 3
+    minimize_job_priority: int = 2
+    vector_job_priority: int = 1
 
+@dataclass
+class DatabaseConfig:
+    # Connection pool, per engine (sync and async) and per process: every replica may open up to 2 * (pool_size + max_overflow) connections.
+    # Keep the total across replicas below the max_connections of the database, and raise these through the environment where it allows.
+    pool_size: int = field(default_factory=lambda: int(os.environ.get("DB_POOL_SIZE", "5")))  # Connections kept open
+    max_overflow: int = field(default_factory=lambda: int(os.environ.get("DB_MAX_OVERFLOW", "5")))  # Extra connections opened under load, closed when returned
+    pool_timeout: int = field(default_factory=lambda: int(os.environ.get("DB_POOL_TIMEOUT", "30")))  # 30 seconds, how long to wait for a connection before giving up
+    pool_pre_ping: bool = True  # Check connections before using them, to survive database restarts
+    pool_recycle: int = 60 * 30  # 30 minutes, connections older than this are replaced
+    # Server-side prepared statements cached per connection by asyncpg. Set to 0 to disable (e.g. behind pgbouncer in transaction mode).
+    prepared_statement_cache_size: int = 100
+
+@dataclass
+class RedisConfig:
+    host: str = "redis"
+    port: int = 6379
+    db: int = 0
+    # Connection pool, per client (sync and async) and per process
+    max_connections: int = 64  # Requests wait for a free connection beyond this
+    pool_timeout: int = 5  # 5 seconds, how long a command waits for a free connection
+    socket_connect_timeout: float = 2  # 2 seconds
+    health_check_interval: int = 30  # 30 seconds, idle connections are checked before use
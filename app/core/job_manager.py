@@ -1,22 +1,163 @@
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select, insert, update, values as sa_values, column, cast, func, Integer, DateTime, Double
 from app.models.job import Job, JobStatus, JobType
+from app.models.channel import Channel
 import redis
+from redis import asyncio as aioredis
+import asyncio
+import threading
 import datetime
 from app.core.config import JobManagerConfig
 from app.db.base import SessionFactory
-from app.core.redis import redis_client
+from app.core.redis import redis_client, async_redis_client
+from app.core.notifier import JOB_QUEUE_CHANNEL, SCHEDULER_EVENTS_CHANNEL
 from functools import wraps
 from sqlalchemy.exc import SQLAlchemyError, OperationalError, IntegrityError, DataError
 import time
+import json
+
+
+# Completed jobs are handed over to the channel manager through a Redis stream, read by a consumer group (see ChannelManager.process_completed_jobs)
+COMPLETIONS_STREAM = "job_completions"
+COMPLETIONS_GROUP = "channel_manager"
+# Completions that failed to be processed too many times are moved to a dead-letter stream, with their original entry ID and delivery count.
+# They can be replayed by adding their fields back to the completions stream.
+COMPLETIONS_DEAD_STREAM = "job_completions:dead"
+
+# Jobs are served by decreasing priority, then from oldest to newest. The priority weighs more than any realistic age difference.
+PRIORITY_WEIGHT = 1e10
+
+def queue_score(priority: int, time_created: datetime.datetime = None) -> float:
+    """Score of a job in the Redis queue (a sorted set). Lower scores are served first."""
+    created = time_created.timestamp() if time_created else time.time()
+    return -(priority or 0) * PRIORITY_WEIGHT + created
+
+# Lua script claiming jobs: pop the best ranked jobs from the queue, lease them to a worker and return their descriptors, in a single atomic step.
+# The claimed jobs are also added to the hot store (see hot_key), so that the worker can ping them right away. Existing hot entries are kept.
+# KEYS: job queue (sorted set), lease expiries (sorted set), lease owners (hash), queue scores of leased jobs (hash), job descriptors (hash).
+# ARGV: worker id, lease expiry (unix time), maximum number of jobs to claim, current unix time, hot hash TTL.
+# Returns: flat list of job id, descriptor pairs. The descriptor is an empty string if it is not in Redis.
+CLAIM_JOBS_SCRIPT = """
+local popped = redis.call('ZPOPMIN', KEYS[1], ARGV[3])
+local claimed = {}
+for i = 1, #popped, 2 do
+    local job_id = popped[i]
+    redis.call('ZADD', KEYS[2], ARGV[2], job_id)
+    redis.call('HSET', KEYS[3], job_id, ARGV[1])
+    redis.call('HSET', KEYS[4], job_id, popped[i + 1])
+    -- A hot entry that already exists belongs to the worker the job is assigned to (e.g. a duplicate queue entry), leave it alone
+    local hot = 'job_hot:' .. job_id
+    if redis.call('EXISTS', hot) == 0 then
+        redis.call('HSET', hot, 'worker_id', ARGV[1], 'status', 'running', 'last_update', ARGV[4])
+        redis.call('EXPIRE', hot, ARGV[5])
+    end
+    table.insert(claimed, job_id)
+    table.insert(claimed, redis.call('HGET', KEYS[5], job_id) or '')
+end
+return claimed
+"""
+
+# Lua script putting the jobs whose lease has expired back in the queue, with their original rank.
+# KEYS: job queue (sorted set), lease expiries (sorted set), lease owners (hash), queue scores of leased jobs (hash).
+# ARGV: current unix time.
+REAP_LEASES_SCRIPT = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])
+for _, job_id in ipairs(expired) do
+    local score = redis.call('HGET', KEYS[4], job_id) or 0
+    redis.call('ZREM', KEYS[2], job_id)
+    redis.call('HDEL', KEYS[3], job_id)
+    redis.call('HDEL', KEYS[4], job_id)
+    redis.call('DEL', 'job_hot:' .. job_id)
+    redis.call('ZADD', KEYS[1], score, job_id)
+end
+return expired
+"""
+
+# Lua script removing the hot store entries of jobs that turned out to be stale after a claim, if they still belong to the claiming worker.
+# Entries of the worker the job is really assigned to are kept, along with their unflushed updates.
+# KEYS: set of jobs with unflushed updates.
+# ARGV: worker id, then the job ids.
+DROP_CLAIMED_HOT_SCRIPT = """
+for i = 2, #ARGV do
+    local hot = 'job_hot:' .. ARGV[i]
+    if redis.call('HGET', hot, 'worker_id') == ARGV[1] then
+        redis.call('DEL', hot)
+        redis.call('SREM', KEYS[1], ARGV[i])
+    end
+end
+"""
+
+# Lua script queueing jobs along with their descriptors. Jobs already in the queue keep their rank.
+# Jobs leased to a worker are skipped: they are still pending in the database until the claim is confirmed, but must not be queued twice.
+# Writes of the scheduler leader are fenced: nothing is queued if a newer leader was elected (see LeaderElection).
+# KEYS: job queue (sorted set), job descriptors (hash), lease owners (hash), optionally the fencing counter of the leader.
+# ARGV: fencing token (ignored without fencing counter), then job id, queue score, descriptor triples.
+# Returns: number of jobs queued, -1 if the fencing token is stale.
+ENQUEUE_JOBS_SCRIPT = """
+if KEYS[4] and redis.call('GET', KEYS[4]) ~= ARGV[1] then
+    return -1
+end
+local queued = 0
+for i = 2, #ARGV, 3 do
+    if redis.call('HEXISTS', KEYS[3], ARGV[i]) == 0 then
+        redis.call('HSET', KEYS[2], ARGV[i], ARGV[i + 2])
+        redis.call('ZADD', KEYS[1], 'NX', ARGV[i + 1], ARGV[i])
+        queued = queued + 1
+    end
+end
+return queued
+"""
+ENQUEUE_BATCH_SIZE = 1000
+
+# Redis keys used by the claim and reap scripts
+LEASE_KEYS = ["job_queue", "job_leases", "job_lease_owners", "job_lease_scores"]
+
+# Columns needed to queue a job along with its descriptor
+QUEUE_COLUMNS = (Job.id, Job.status, Job.priority, Job.time_created, Job.job_type, Job.input_data, Job.kraus_operator, Job.vector, Job.channel_id)
+
+# Lua script buffering a heartbeat (and optionally progress) of a worker in the hot store, if the job is assigned to this worker.
+# KEYS: hot hash of the job, set of jobs with unflushed updates.
+# ARGV: worker id, job id, hot hash TTL, "1" if the job must be running, then field/value pairs to set (including last_update).
+# Returns: -1 if the job is not in the hot store, 0 if it is not assigned to the worker (or not running), 1 on success.
+RECORD_PROGRESS_SCRIPT = """
+local worker_id = redis.call('HGET', KEYS[1], 'worker_id')
+if not worker_id then
+    return -1
+end
+if worker_id ~= ARGV[1] then
+    return 0
+end
+if ARGV[4] == '1' and redis.call('HGET', KEYS[1], 'status') ~= 'running' then
+    return 0
+end
+redis.call('HSET', KEYS[1], unpack(ARGV, 5))
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('SADD', KEYS[2], ARGV[2])
+return 1
+"""
+
+def hot_key(job_id) -> str:
+    """Redis key of the hot store entry of a job: a hash with its worker, status, last ping and latest progress."""
+    return f"job_hot:{job_id}"
 
 
 class JobManager:
-    def __init__(self, redis_client: redis.Redis, config: JobManagerConfig = JobManagerConfig()):
+    def __init__(self, redis_client: redis.Redis, config: JobManagerConfig = JobManagerConfig(), async_redis: aioredis.Redis = None):
+        self._local = threading.local()
         self.db = None # Database session, this is set using the _get_session method
         # In-memory storage (fast access, queue)
         self.redis = redis_client
-        # Sync the jobs in the database with the Redis queue
-        self.sync_jobs()
+        # Async client, used by the async API (endpoints running on the event loop)
+        self.aredis = async_redis
+        # Claimed jobs are leased to the worker until the database knows about the assignment
+        self._reap_leases = self.redis.register_script(REAP_LEASES_SCRIPT)
+        self._drop_claimed_hot = self.redis.register_script(DROP_CLAIMED_HOT_SCRIPT)
+        self._enqueue = self.redis.register_script(ENQUEUE_JOBS_SCRIPT)
+        # Jobs are claimed, and heartbeats and progress of running jobs buffered in Redis (flushed to the database in batches), by the async endpoints
+        if self.aredis is not None:
+            self._claim_jobs_async = self.aredis.register_script(CLAIM_JOBS_SCRIPT)
+            self._record_progress_async = self.aredis.register_script(RECORD_PROGRESS_SCRIPT)
         # Configuration
         self.config = config
     
@@ -27,6 +168,15 @@ class JobManager:
     ############################
 
 
+    @property
+    def db(self):
+        """Database session of the current thread. The scheduler thread and the API threads each get their own."""
+        return getattr(self._local, "db", None)
+
+    @db.setter
+    def db(self, session):
+        self._local.db = session
+
     def _get_session(self):
         """Get a new database session. Handle Exceptions"""
         try:
@@ -81,7 +231,7 @@ class JobManager:
     # Job management logic
     ############################
 
-    def manage_jobs(self):
+    def manage_jobs(self, fence: tuple = None):
         '''
         Manage the jobs in the database. This function is called periodically to check the status of jobs and workers.
         It performs the following tasks:
@@ -89,83 +239,148 @@ class JobManager:
         - Restart paused jobs that have exceeded the pause TTL
         - Restart running jobs that have exceeded the running TTL
         - Restart canceled jobs
+        Each task is a single UPDATE ... RETURNING, backed by the (status, last_update) and (status, time_started) indexes.
+        The restarted jobs are pushed back to the Redis queue in one go.
+        If a fence is given (see LeaderElection.fence), nothing is committed or queued once a newer leader was elected.
         '''
         print("Now managing jobs...!")
+        # Put back in the queue the jobs that were claimed but never confirmed
+        self.reap_expired_leases()
+        # Write the buffered heartbeats to the database, so that the sweeps see the latest pings
+        self.flush_hot_updates()
         # get a new session (this has to be separate from db, since that is used in the individual methods)
         session = self._get_session()
         if not session:
             print("Failed to get a session.")
             return
-        running_jobs = session.query(Job).filter(Job.status == JobStatus.running).all()
-        paused_jobs = session.query(Job).filter(Job.status == JobStatus.paused).all()
-        canceled_jobs = session.query(Job).filter(Job.status == JobStatus.canceled).all()
-        # Mark jobs of workers that have not pinged the server in a while as available
-        for job in running_jobs:
-            if job.last_update + datetime.timedelta(seconds=self.config.job_ping_ttl) < datetime.datetime.now():
-                print(f"Worker {job.worker_id} has not pinged the server in a while. Marking job as available.")
-                self.restart_job(job.id)
-        # Restart paused jobs that have exceeded the pause TTL
-        # TODO: notify the user?
-        for job in paused_jobs:
-            if job.time_started + datetime.timedelta(seconds=self.config.job_paused_ttl) < datetime.datetime.now():
-                print(f"Job {job.id} has been paused for too long. Restarting.")
-                self.restart_job(job.id)
-        # Restart running jobs that have exceeded the running TTL
+        now = datetime.datetime.now()
         # TODO: notify the user?
-        for job in running_jobs:
-            if job.time_started + datetime.timedelta(seconds=self.config.job_running_ttl) < datetime.datetime.now():
-                print(f"Job {job.id} has been running for too long. Restarting.")
-                self.restart_job(job.id)
-        # Reschedule cancelled jobs. Simply spawn a new job with the same information.
-        for job in canceled_jobs:
-            print(f"Job {job.id} was canceled. Restarting.")
-            self.create_job(job.job_type, job.input_data, job.kraus_operator, job.vector, job.channel_id)
-
-#            self.restart_job(job.id)
+        sweeps = [
+            ("was not pinged by its worker in a while", Job.status == JobStatus.running, Job.last_update < now - datetime.timedelta(seconds=self.config.job_ping_ttl)),
+            ("has been paused for too long", Job.status == JobStatus.paused, Job.time_started < now - datetime.timedelta(seconds=self.config.job_paused_ttl)),
+            ("has been running for too long", Job.status == JobStatus.running, Job.time_started < now - datetime.timedelta(seconds=self.config.job_running_ttl)),
+            ("was canceled", Job.status == JobStatus.canceled),
+        ]
+        restarted = []
+        try:
+            for reason, *conditions in sweeps:
+                jobs = session.execute(
+                    update(Job)
+                    .where(*conditions)
+                    .values(status=JobStatus.pending, time_started=None, time_finished=None, last_update=now)
+                    .returning(*QUEUE_COLUMNS)
+                    .execution_options(synchronize_session=False)
+                ).all()
+                for job in jobs:
+                    print(f"Job {job.id} {reason}. Restarting.")
+                restarted.extend(jobs)
+            if fence and not self.fence_holds(fence):
+                print("A newer scheduler leader was elected. Not restarting jobs.")
+                session.rollback()
+                return
+            session.commit()
+        except Exception as e:
+            print(f"Error while managing jobs: {e}")
+            session.rollback()
+            raise
+        finally:
+            # Close the session
+            session.close()
+        # Forget the heartbeats of the restarted jobs and put them back in the queue
+        pipe = self.redis.pipeline()
+        self._drop_hot_jobs([job.id for job in restarted], pipe=pipe)
+        self._enqueue_jobs(restarted, pipe=pipe, fence=fence)
+        pipe.execute()
         print("Job management complete.")
-        # Close the session
-        session.close()
 
 
-    def sync_jobs(self):
+    def sync_jobs(self, incremental: bool = False, fence: tuple = None):
         '''
-        Sync the jobs in the database with the Redis queue. This can be expensive if there are many jobs.
+        Sync the jobs in the database with the Redis queue.
         The goal is to ensure that all pending jobs are in the Redis queue and that the queue does not contain jobs that are no longer pending.
+        A full sync reads the queue once and all pending jobs with a single query. An incremental sync only looks at the jobs updated since the last sync.
+        In both cases the difference is applied in one pipeline. If a fence is given (see LeaderElection.fence), no job is queued once a newer leader was elected.
         '''
-        print("Syncing jobs...")
+        print("Syncing jobs..." if not incremental else "Syncing recently updated jobs...")
         session = self._get_session()
-        # Make sure all pending jobs are in the Redis queue
-        pending_jobs = session.query(Job).filter(Job.status == JobStatus.pending).all()
-        # Add pending jobs to the Redis queue if they are not already there
-        for job in pending_jobs:
-            if not self.redis.lrange("job_queue", 0, -1):
-                self.redis.rpush("job_queue", job.id)
-                continue
-            elif job.id not in self.redis.lrange("job_queue", 0, -1):
-                self.redis.rpush("job_queue", job.id)
-                continue
-        else:
-            print("No pending jobs to add to the Redis queue.")
-        # Next purge the Redis queue of jobs that are no longer pending
-        job_queue = self.redis.lrange("job_queue", 0, -1)
-        for job_id in job_queue:
-            #cast to int
-            job_id = int(job_id)
-            job = session.query(Job).filter(Job.id == job_id).first()
-            if job.status != JobStatus.pending:
-                self.redis.lrem("job_queue", 0, job_id)
-                continue
-        else:
-            print("No non-pending jobs to remove from the Redis queue.")
-        session.close()
-        print("Job sync complete.")
+        if not session:
+            print("Failed to get a session.")
+            return
+        try:
+            now = datetime.datetime.now()
+            watermark = self.redis.get("job_sync_watermark")
+
+            if incremental and watermark:
+                # Go back a bit before the watermark, to catch the transactions that were still committing during the last sync
+                since = datetime.datetime.fromtimestamp(float(watermark)) - datetime.timedelta(seconds=self.config.job_sync_overlap)
+                jobs = session.query(*QUEUE_COLUMNS).filter(Job.last_update >= since).all()
+                to_add = [job for job in jobs if job.status == JobStatus.pending]
+                to_remove = [job.id for job in jobs if job.status != JobStatus.pending]
+            else:
+                # The queue used to be a Redis list. Drop it, it is rebuilt below.
+                if self.redis.type("job_queue") == b"list":
+                    print("Found a job queue in the old format. Rebuilding it.")
+                    self.redis.delete("job_queue")
+                queued = {int(job_id) for job_id in self.redis.zrange("job_queue", 0, -1)}
+                pending_jobs = session.query(*QUEUE_COLUMNS).filter(Job.status == JobStatus.pending).all()
+                pending_ids = {job.id for job in pending_jobs}
+                to_add = [job for job in pending_jobs if job.id not in queued]
+                to_remove = list(queued - pending_ids)
+        finally:
+            session.close()
+
+        # Apply the difference in a single round trip. Queued jobs keep their rank, jobs being claimed right now are skipped (see ENQUEUE_JOBS_SCRIPT).
+        pipe = self.redis.pipeline()
+        self._enqueue_jobs(to_add, pipe=pipe, fence=fence)
+        if to_remove:
+            pipe.zrem("job_queue", *to_remove)
+        pipe.set("job_sync_watermark", now.timestamp())
+        pipe.execute()
+        print(f"Job sync complete. Queued {len(to_add)} jobs, removed {len(to_remove)} jobs that are no longer pending.")
+
+    def _enqueue_jobs(self, jobs: list, pipe = None, fence: tuple = None):
+        """
+        Add jobs to the Redis queue, ranked by priority and age, and wake up the workers waiting for a job.
+        The job descriptors are stored next to the queue, so that jobs can be assigned without touching the database.
+        Jobs already in the queue keep their rank and leased jobs are skipped. If a pipeline is given, the commands are added to it and the caller executes it.
+        If a fence is given (see LeaderElection.fence), nothing is queued once a newer leader was elected.
+        """
+        if not jobs:
+            return
+        execute = pipe is None
+        if execute:
+            pipe = self.redis.pipeline()
+        keys = ["job_queue", "job_descriptors", "job_lease_owners"]
+        token = ""
+        if fence:
+            keys.append(fence[0])
+            token = fence[1]
+        # One script call per batch, so that a full sync does not block Redis for long
+        for start in range(0, len(jobs), ENQUEUE_BATCH_SIZE):
+            args = [token]
+            for job in jobs[start:start + ENQUEUE_BATCH_SIZE]:
+                args += [job.id, queue_score(job.priority, job.time_created), json.dumps(self._job_descriptor(job))]
+            self._enqueue(keys=keys, args=args, client=pipe)
+        pipe.publish(JOB_QUEUE_CHANNEL, len(jobs))
+        if execute:
+            pipe.execute()
+
+    def fence_holds(self, fence: tuple) -> bool:
+        """
+        Whether no newer scheduler leader was elected since the fencing token was issued. One round trip, check it right before a leader-only write.
+        fence: (fence key, fencing token), see LeaderElection.fence.
+        """
+        if not fence:
+            return False
+        token = self.redis.get(fence[0])
+        return token is not None and int(token) == fence[1]
 
     #############################
     # Job creation and assignment
     #############################
 
-    def create_job(self, job_type: JobType, input_data: dict, kraus_operators: str = None, vector: str = None, channel_id: int = -1):
-        """Create a new job and queue it."""
+    def create_job(self, job_type: JobType, input_data: dict, kraus_operators: str = None, vector: str = None, channel_id: int = -1, priority: int = 1):
+        """Create a new job and queue it. Jobs with a higher priority are assigned first."""
         if job_type == JobType.minimize:
             # debug. print all passed things
             print("Passed input data:", input_data)
@@ -173,16 +388,16 @@ class JobManager:
             print("Passed vector:", vector)
 
             if vector and kraus_operators:
-                new_job = Job(job_type=JobType.minimize, status=JobStatus.pending, input_data=input_data, kraus_operator=kraus_operators, vector=vector, channel_id=channel_id)
+                new_job = Job(job_type=JobType.minimize, status=JobStatus.pending, input_data=input_data, kraus_operator=kraus_operators, vector=vector, channel_id=channel_id, priority=priority)
             else:
                 print("Missing required parameters for minimize job.")
                 return None
 
         elif job_type == JobType.generate_kraus:
-            new_job = Job(job_type=JobType.generate_kraus, status=JobStatus.pending, input_data=input_data, channel_id=channel_id)
+            new_job = Job(job_type=JobType.generate_kraus, status=JobStatus.pending, input_data=input_data, channel_id=channel_id, priority=priority)
 
         elif job_type == JobType.generate_vector:
-            new_job = Job(job_type=JobType.generate_vector, status=JobStatus.pending, input_data=input_data, channel_id=channel_id)
+            new_job = Job(job_type=JobType.generate_vector, status=JobStatus.pending, input_data=input_data, channel_id=channel_id, priority=priority)
         else:
             print("Invalid job type.")
             return None
@@ -197,53 +412,171 @@ class JobManager:
         session.close()
 
         # Add job to Redis queue
-        self.redis.rpush("job_queue", new_job.id)
+        self._enqueue_jobs([new_job])
         return new_job
     
 
-    @ensure_session         
-    def assign_job_to_worker(self, worker_id: str):
-            """Assign a job to an available worker."""
-            print("Assigning job to worker:", worker_id)
-            # Get a job from the Redis queue
-            job_id = self.redis.lpop("job_queue")
-            if not job_id:
-                print("No jobs available.")
-                return None  # No jobs available
-            job_id = int(job_id)
-            print("Job ID:", job_id)
-
-            # Lock the job and mark it as 'running' in the database
-            session = self._get_session()
-            job = session.query(Job).filter(Job.id == job_id).first()
-
-            if not job:
-                # Database inconsistency: job in the queue but not in the database
-                # Log this
-                print(f"Job {job_id} not found in the database, but present in Redis.")
-                return self.assign_job_to_worker(worker_id)  # Retry
-
-            if job.status != JobStatus.pending:
-                # Job is not available for assignment (already running, completed, etc.)
-                print("Possible database inconsistency: Job is not pending.")
-                print("Job status:", job.status)
-                print("Will refresh the Redis queue.")
-                self.sync_jobs()
-                return self.assign_job_to_worker(worker_id)  # Retry
-
-            # Update the job status to "running" and assign the worker
-            job.status = JobStatus.running
-            job.worker_id = worker_id  # Assign the job to the worker
-            job.time_started = datetime.datetime.now()
-            job.last_update = datetime.datetime.now()
-            session.commit()
-            session.close()
-            print("Job assigned to worker:", worker_id)
-            return job
+    @ensure_session
+    def create_jobs_bulk(self, specs: list, runs_spawned: dict = None, fence: tuple = None):
+        """
+        Create many jobs with a single INSERT ... RETURNING and queue them with a single pipeline.
+        Each spec is a dict with the create_job arguments: job_type, input_data, and optionally kraus_operators, vector, channel_id and priority.
+        runs_spawned maps channel IDs to the number of runs to add to their runs_spawned counter, in the same transaction.
+        If a fence is given (see LeaderElection.fence), nothing is created once a newer leader was elected.
+        Returns: list of the created jobs (rows with the queue columns).
+        """
+        jobs = self.insert_jobs(self.db, specs)
+        for channel_id, n in (runs_spawned or {}).items():
+            self.db.execute(update(Channel).where(Channel.id == channel_id).values(runs_spawned=Channel.runs_spawned + n))
+        if fence and not self.fence_holds(fence):
+            print("A newer scheduler leader was elected. Not creating jobs.")
+            self.db.rollback()
+            return []
+        self.db.commit()
+        # Add jobs to Redis queue
+        self._enqueue_jobs(jobs, fence=fence)
+        print(f"Created {len(jobs)} jobs.")
+        return jobs
+
+    def insert_jobs(self, session: Session, specs: list):
+        """
+        Insert many jobs with a single statement, in the given session. The caller commits, then queues the jobs.
+        Invalid specs (e.g. minimize jobs without kraus operators or vector) are skipped.
+        Returns: list of the inserted jobs (rows with the queue columns).
+        """
+        now = datetime.datetime.now()
+        rows = []
+        for spec in specs:
+            job_type = JobType(spec["job_type"])
+            if job_type == JobType.minimize and not (spec.get("vector") and spec.get("kraus_operators")):
+                print("Missing required parameters for minimize job.")
+                continue
+            rows.append({
+                "job_type": job_type,
+                "status": JobStatus.pending,
+                "input_data": spec["input_data"],
+                "kraus_operator": spec.get("kraus_operators") if job_type == JobType.minimize else None,
+                "vector": spec.get("vector") if job_type == JobType.minimize else None,
+                "channel_id": spec.get("channel_id", -1),
+                "priority": spec.get("priority", 1),
+                "time_created": now,
+                "last_update": now,
+            })
+        if not rows:
+            return []
+        return session.execute(insert(Job).values(rows).returning(*QUEUE_COLUMNS)).all()
+
+    def _claim_args(self, worker_id: str, n: int) -> list:
+        """Arguments of the claim jobs script."""
+        return [worker_id, time.time() + self.config.job_claim_lease_ttl, n, time.time(), 2 * self.config.job_ping_ttl]
+
+    def _parse_claimed(self, claimed: list):
+        """
+        Parse the result of the claim jobs script.
+        Returns: list of job descriptors, list of job IDs without a descriptor in Redis.
+        """
+        jobs = []
+        missing = []
+        for job_id, descriptor in zip(claimed[::2], claimed[1::2]):
+            if descriptor:
+                jobs.append(json.loads(descriptor))
+            else:
+                missing.append(int(job_id))
+        return jobs, missing
+
+    def _claimed(self, worker_id: str, jobs: list, missing: list):
+        """Log the claimed jobs. Returns: list of job descriptors, list of job IDs to confirm."""
+        if not jobs:
+            print("No jobs available.")
+        else:
+            print(f"Claimed {len(jobs)} jobs for worker:", worker_id)
+        return jobs, [job["job_id"] for job in jobs if job["job_id"] not in missing]
+
+    @ensure_session
+    def confirm_claims(self, worker_id: str, job_ids: list):
+        """
+        Mark claimed jobs as running and assigned to the worker in the database, with a single UPDATE, then release their leases.
+        Only pending jobs are updated, so a duplicate queue entry cannot be assigned twice. Stale entries are dropped, without touching the hot entry of the worker that owns the job.
+        Returns: list of descriptors of the confirmed jobs.
+        """
+        if not job_ids:
+            return []
+        now = datetime.datetime.now()
+        jobs = self.db.execute(
+            update(Job)
+            .where(Job.id.in_(job_ids), Job.status == JobStatus.pending)
+            .values(status=JobStatus.running, worker_id=worker_id, time_started=now, last_update=now)
+            .returning(Job.id, Job.job_type, Job.input_data, Job.kraus_operator, Job.vector, Job.channel_id)
+            .execution_options(synchronize_session=False)
+        ).all()
+        self.db.commit()
+        # The database now knows about the assignment, the leases are no longer needed
+        stale = set(job_ids) - {job.id for job in jobs}
+        pipe = self.redis.pipeline()
+        self._release_leases(job_ids, pipe=pipe)
+        # The lease may have expired before the commit, which put the confirmed jobs back in the queue
+        if jobs:
+            pipe.zrem("job_queue", *[job.id for job in jobs])
+        # Stale queue entries (jobs missing from the database, or already running, completed, etc.) must not accept heartbeats from this worker
+        if stale:
+            self._drop_claimed_hot(keys=["job_hot_dirty"], args=[worker_id, *stale], client=pipe)
+        pipe.execute()
+        if stale:
+            print(f"Jobs {sorted(stale)} are missing or not pending anymore. Dropped them from the queue.")
+        print(f"Confirmed {len(jobs)} jobs for worker:", worker_id)
+        return [self._job_descriptor(job) for job in jobs]
+
+    def _job_descriptor(self, job) -> dict:
+        """All the info a worker needs to run a job once it is assigned, e.g. kraus id and vector id."""
+        return {
+            "job_id": job.id,
+            "job_type": JobType(job.job_type).value,
+            "job_data": job.input_data,
+            "job_status": JobStatus.running.value,
+            "kraus_id": job.kraus_operator,
+            "vector_id": job.vector,
+            "channel_id": job.channel_id
+        }
+
+    def _release_leases(self, job_ids: list, pipe = None):
+        """Release the leases of claimed jobs. If a pipeline is given, the commands are added to it and the caller executes it."""
+        execute = pipe is None
+        if execute:
+            pipe = self.redis.pipeline()
+        pipe.zrem("job_leases", *job_ids)
+        pipe.hdel("job_lease_owners", *job_ids)
+        pipe.hdel("job_lease_scores", *job_ids)
+        if execute:
+            pipe.execute()
+
+    def reap_expired_leases(self):
+        """Put the jobs whose lease has expired back in the queue. Returns the IDs of the requeued jobs."""
+        expired = [int(job_id) for job_id in self._reap_leases(keys=LEASE_KEYS, args=[time.time()])]
+        if expired:
+            print(f"Leases expired for jobs {expired}. Jobs were put back in the queue.")
+        return expired
 
     ############################
     #          Getters
     ############################
+    def _snapshot_statement(self, job_id: int):
+        """Query of the job snapshot."""
+        return select(Job.id, Job.status, Job.worker_id, Job.job_type, Job.kraus_operator, Job.vector, Job.channel_id).where(Job.id == int(job_id))
+
+    def _snapshot(self, job) -> dict:
+        """Build the job snapshot from the result of the snapshot query."""
+        if not job:
+            return None
+        return {
+            "id": job.id,
+            "status": job.status.value,
+            "worker_id": job.worker_id,
+            "job_type": job.job_type.value,
+            "kraus_operator": job.kraus_operator,
+            "vector": job.vector,
+            "channel_id": job.channel_id
+        }
+
     @ensure_session
     def get_assigned_worker(self, job_id: int):
         """Get the worker assigned to a job."""
@@ -318,9 +651,12 @@ class JobManager:
         job = self.db.query(Job).filter(Job.id == job_id).first()
         if not job:
             return None
+        self._apply_hot_updates(job)
         job.status = status
         job.last_update = datetime.datetime.now()
+        worker_id = job.worker_id
         self.db.commit()
+        self._sync_hot_status(job_id, worker_id, status)
         return job
 
     @ensure_session
@@ -382,25 +718,72 @@ class JobManager:
         job = self.db.query(Job).filter(Job.id == job_id).first()
         if not job:
             return None
+        self._mark_completed(job)
+        self.db.commit()
+        self._hand_over_completed(job.id)
+        return job  
+
+    def _mark_completed(self, job: Job, apply_hot: bool = True):
+        """Mark a job row as completed. Does not commit."""
+        # The final progress (e.g. entropy) may still be buffered in the hot store
+        if apply_hot:
+            self._apply_hot_updates(job)
         job.status = JobStatus.completed
         job.time_finished = datetime.datetime.now()
         job.last_update = datetime.datetime.now()
-        self.db.commit()
-        self.redis.rpush("to_process", job.id)
-        return job  
+
+    def _hand_over_completed(self, job_id: int, pipe = None):
+        """
+        Once a completed job is committed, remove it from the hot store and hand it over to the channel manager, waking up the scheduler.
+        If a pipeline is given, the caller executes it.
+        """
+        execute = pipe is None
+        if execute:
+            pipe = self.redis.pipeline()
+        self._drop_hot_jobs([job_id], pipe=pipe)
+        pipe.hdel("job_descriptors", job_id)
+        pipe.xadd(COMPLETIONS_STREAM, {"job_id": job_id})
+        pipe.publish(SCHEDULER_EVENTS_CHANNEL, f"completed:{job_id}")
+        if execute:
+            pipe.execute()
 
     @ensure_session
     def restart_job(self, job_id: int):
         """Restart a job that was previously paused."""
         job = self.db.query(Job).filter(Job.id == job_id).first()
+        self._apply_hot_updates(job)
         job.status = JobStatus.pending
         job.time_started = None
         job.time_finished = None
         job.last_update = datetime.datetime.now()
         self.db.commit()
-        self.redis.rpush("job_queue", job.id)
+        pipe = self.redis.pipeline()
+        self._drop_hot_jobs([job.id], pipe=pipe)
+        self._enqueue_jobs([job], pipe=pipe)
+        pipe.execute()
         return job
 
+    @ensure_session
+    def set_priority(self, priority: int, job_ids: list = None, channel_id: int = None):
+        """
+        Change the priority of pending jobs, selected by ID and/or by channel. The jobs are re-ranked in the Redis queue in place.
+        Returns: IDs of the updated jobs.
+        """
+        query = self.db.query(Job).filter(Job.status == JobStatus.pending)
+        if job_ids is not None:
+            query = query.filter(Job.id.in_(job_ids))
+        if channel_id is not None:
+            query = query.filter(Job.channel_id == channel_id)
+        jobs = query.all()
+        for job in jobs:
+            job.priority = priority
+        self.db.commit()
+        # Only re-rank jobs that are still waiting in the queue (XX), claimed jobs must not be queued again
+        scores = {job.id: queue_score(job.priority, job.time_created) for job in jobs}
+        if scores:
+            self.redis.zadd("job_queue", scores, xx=True)
+        return list(scores)
+
     @ensure_session
     def ping_worker(self, worker_id: str, job_id: int):
         """Update the last ping time for a worker."""
@@ -413,10 +796,228 @@ class JobManager:
         self.db.commit()
         return job
 
+    ############################
+    #  Heartbeats and progress
+    ############################
+
+    # Heartbeats, iteration counts and entropies of running jobs are written to a Redis hash per job (the hot store),
+    # and flushed to the database in batches by flush_hot_updates. The hash also records the worker and status of the job,
+    # so that workers can be authorized without touching the database.
+
+    def _progress_script_params(self, worker_id: str, job_id: int, num_iterations: int = None, entropy: float = None, require_running: bool = False) -> dict:
+        """Keys and arguments of the record progress script."""
+        job_id = int(job_id)
+        fields = {"last_update": time.time()}
+        if num_iterations is not None:
+            fields["num_iterations"] = num_iterations
+        if entropy is not None:
+            fields["entropy"] = entropy
+        args = [worker_id, job_id, 2 * self.config.job_ping_ttl, "1" if require_running else "0"]
+        for field, value in fields.items():
+            args.extend([field, value])
+        return {"keys": [hot_key(job_id), "job_hot_dirty"], "args": args}
+
+    def _apply_progress(self, job: Job, worker_id: str, num_iterations: int = None, entropy: float = None, require_running: bool = False):
+        """Write a heartbeat and progress onto a job row, if the job is assigned to the worker. Does not commit. Same return values as record_progress_async."""
+        if not job:
+            return None
+        if job.worker_id != worker_id or (require_running and job.status != JobStatus.running):
+            return False
+        if num_iterations is not None:
+            job.num_iterations = num_iterations
+        if entropy is not None:
+            job.entropy = entropy
+        job.last_update = datetime.datetime.now()
+        return True
+
+    def _sync_hot_status(self, job_id: int, worker_id: str, status: JobStatus, pipe = None):
+        """Keep the hot store in line with a committed status: only running and paused jobs accept heartbeats and progress. If a pipeline is given, the caller executes it."""
+        if status in (JobStatus.running, JobStatus.paused):
+            self._set_hot_job(job_id, worker_id, status, pipe=pipe)
+        else:
+            self._drop_hot_jobs([job_id], pipe=pipe)
+
+    def _set_hot_job(self, job_id: int, worker_id: str, status: JobStatus, pipe = None):
+        """Create (or reset the status of) the hot store entry of a job. If a pipeline is given, the caller executes it."""
+        execute = pipe is None
+        if execute:
+            pipe = self.redis.pipeline()
+        pipe.hset(hot_key(job_id), mapping={"worker_id": worker_id, "status": status.value})
+        pipe.hsetnx(hot_key(job_id), "last_update", time.time())
+        pipe.expire(hot_key(job_id), 2 * self.config.job_ping_ttl)
+        if execute:
+            pipe.execute()
+
+    def _drop_hot_jobs(self, job_ids: list, pipe = None):
+        """Remove jobs from the hot store, e.g. once they are completed or restarted. If a pipeline is given, the caller executes it."""
+        if not job_ids:
+            return
+        execute = pipe is None
+        if execute:
+            pipe = self.redis.pipeline()
+        pipe.delete(*[hot_key(job_id) for job_id in job_ids])
+        pipe.srem("job_hot_dirty", *job_ids)
+        if execute:
+            pipe.execute()
+
+    def _parse_hot(self, hot: dict) -> dict:
+        """Parse the buffered updates of a hot store entry into column values."""
+        values = {}
+        if b"last_update" in hot:
+            values["last_update"] = datetime.datetime.fromtimestamp(float(hot[b"last_update"]))
+        if b"num_iterations" in hot:
+            values["num_iterations"] = int(hot[b"num_iterations"])
+        if b"entropy" in hot:
+            values["entropy"] = float(hot[b"entropy"])
+        return values
+
+    def _apply_hot_updates(self, job: Job):
+        """Copy the buffered updates of a job onto its row, before it leaves the hot store. Does not commit."""
+        self._apply_hot_values(job, self.redis.hgetall(hot_key(job.id)))
+
+    def _apply_hot_values(self, job: Job, hot: dict):
+        """Copy the content of a hot store entry onto a job row. Does not commit."""
+        for column, value in self._parse_hot(hot).items():
+            if column == "last_update" and job.last_update and job.last_update > value:
+                continue
+            setattr(job, column, value)
+
+    def flush_hot_updates(self):
+        """
+        Write the buffered heartbeats and progress to the database, with one UPDATE ... FROM (VALUES ...) per batch.
+        Only running and paused jobs are updated, so that stale buffered values never overwrite those of a job that was completed in the meantime.
+        Returns: number of flushed jobs.
+        """
+        flushed = 0
+        while True:
+            job_ids = [int(job_id) for job_id in self.redis.spop("job_hot_dirty", self.config.job_hot_flush_batch)]
+            if not job_ids:
+                break
+            pipe = self.redis.pipeline()
+            for job_id in job_ids:
+                pipe.hgetall(hot_key(job_id))
+            rows = []
+            for job_id, hot in zip(job_ids, pipe.execute()):
+                values = self._parse_hot(hot)
+                # The job may have left the hot store in the meantime (e.g. completed), its updates were then already applied
+                if "last_update" in values:
+                    rows.append((job_id, values["last_update"], values.get("num_iterations"), values.get("entropy")))
+            if not rows:
+                continue
+            buffered = sa_values(
+                column("id", Integer), column("last_update", DateTime), column("num_iterations", Integer), column("entropy", Double),
+                name="buffered"
+            ).data(rows)
+            session = self._get_session()
+            try:
+                session.execute(
+                    update(Job)
+                    # Only jobs still in the hot store: a job completed (or restarted) after its updates were read already has its final values
+                    .where(Job.id == buffered.c.id, Job.status.in_((JobStatus.running, JobStatus.paused)))
+                    .values(
+                        last_update=func.greatest(Job.last_update, cast(buffered.c.last_update, DateTime)),
+                        num_iterations=func.coalesce(cast(buffered.c.num_iterations, Integer), Job.num_iterations),
+                        entropy=func.coalesce(cast(buffered.c.entropy, Double), Job.entropy),
+                    )
+                    .execution_options(synchronize_session=False)
+                )
+                session.commit()
+            except Exception as e:
+                print(f"Error while flushing buffered job updates: {e}")
+                session.rollback()
+                # Flush these jobs again next time
+                self.redis.sadd("job_hot_dirty", *[row[0] for row in rows])
+                raise
+            finally:
+                session.close()
+            flushed += len(rows)
+        if flushed:
+            print(f"Flushed buffered updates of {flushed} jobs.")
+        return flushed
+
+    ############################
+    #  Async API (endpoints)
+    ############################
+
+    # The worker endpoints run on the event loop, with an AsyncSession per request (see get_async_db) and the async Redis client.
+    # Status updates mirror their sync counterparts (used by the scheduler) and share their logic. Redis commands that belong together are sent in one pipeline.
+
+    async def claim_jobs_async(self, worker_id: str, n: int):
+        """
+        Claim up to n jobs for a worker, using Redis only.
+        The jobs are popped from the queue and leased to the worker in a single atomic step, which also returns their precomputed descriptors.
+        The caller must then call confirm_claims with the unconfirmed job IDs, e.g. after responding to the worker, to mark the jobs as running in the database.
+        If that never happens, reap_expired_leases puts the jobs back in the queue.
+        Jobs without a descriptor in Redis (e.g. queued by an older version) are confirmed right away, their descriptors come from the database.
+        Returns: list of job descriptors (empty if no job is available), list of job IDs to confirm.
+        """
+        print(f"Claiming up to {n} jobs for worker:", worker_id)
+        jobs, missing = self._parse_claimed(await self._claim_jobs_async(keys=LEASE_KEYS + ["job_descriptors"], args=self._claim_args(worker_id, n)))
+        if missing:
+            print(f"No descriptor in Redis for jobs {missing}. Loading them from the database.")
+            jobs.extend(await asyncio.to_thread(self.confirm_claims, worker_id, missing))
+        return self._claimed(worker_id, jobs, missing)
+
+    async def get_job_snapshot_async(self, db: AsyncSession, job_id: int):
+        """
+        Retrieve everything the worker endpoints need to know about a job (status, assigned worker, type and file references) with a single query.
+        Returns: dict with the job snapshot, None if the job does not exist.
+        """
+        result = await db.execute(self._snapshot_statement(job_id))
+        return self._snapshot(result.first())
+
+    async def update_job_status_async(self, db: AsyncSession, job_id: int, status: JobStatus):
+        """Async version of update_job_status."""
+        job = await db.get(Job, int(job_id))
+        if not job:
+            return None
+        self._apply_hot_values(job, await self.aredis.hgetall(hot_key(job.id)))
+        job.status = status
+        job.last_update = datetime.datetime.now()
+        worker_id = job.worker_id
+        await db.commit()
+        pipe = self.aredis.pipeline()
+        self._sync_hot_status(job.id, worker_id, status, pipe=pipe)
+        await pipe.execute()
+        return job
+
+    async def complete_job_async(self, db: AsyncSession, job_id: int):
+        """Async version of complete_job."""
+        job = await db.get(Job, int(job_id))
+        if not job:
+            return None
+        self._apply_hot_values(job, await self.aredis.hgetall(hot_key(job.id)))
+        self._mark_completed(job, apply_hot=False)
+        await db.commit()
+        pipe = self.aredis.pipeline()
+        self._hand_over_completed(job.id, pipe=pipe)
+        await pipe.execute()
+        return job
+
+    async def record_progress_async(self, db: AsyncSession, worker_id: str, job_id: int, num_iterations: int = None, entropy: float = None, require_running: bool = False):
+        """
+        Record a heartbeat and progress (number of iterations, entropy) of a worker for a job, in the hot store.
+        Falls back to the database if the job is not in the hot store (e.g. it expired while the job was paused).
+        Returns: True on success, False if the job is not assigned to the worker (or not running), None if the job does not exist.
+        """
+        result = await self._record_progress_async(**self._progress_script_params(worker_id, job_id, num_iterations, entropy, require_running))
+        if result != -1:
+            return result == 1
+        job = await db.get(Job, int(job_id))
+        result = self._apply_progress(job, worker_id, num_iterations, entropy, require_running)
+        if not result:
+            return result
+        status = job.status
+        await db.commit()
+        pipe = self.aredis.pipeline()
+        self._sync_hot_status(job.id, worker_id, status, pipe=pipe)
+        await pipe.execute()
+        return True
+
 # ------------------------------
 # Job Manager logic
 # ------------------------------
 
-job_manager = JobManager(redis_client)
+job_manager = JobManager(redis_client, async_redis=async_redis_client)
 
 
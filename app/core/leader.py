@@ -0,0 +1,132 @@
+import os
+import socket
+import threading
+import time
+import uuid
+import redis
+from app.core.redis import redis_client
+
+
+# Take the lock if it is free. Every new leader gets the next fencing token.
+# KEYS: lock, fencing counter. ARGV: owner, ttl in milliseconds.
+ACQUIRE_LEADERSHIP_SCRIPT = """
+if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+    return redis.call('INCR', KEYS[2])
+end
+return 0
+"""
+
+# Extend the lock, if it is still held by the owner and no newer leader was elected in the meantime.
+# KEYS: lock, fencing counter. ARGV: owner, ttl in milliseconds, fencing token.
+RENEW_LEADERSHIP_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] and redis.call('GET', KEYS[2]) == ARGV[3] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# Release the lock, only if it is still held by the owner.
+# KEYS: lock. ARGV: owner.
+RELEASE_LEADERSHIP_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class LeaderElection:
+    """
+    Lease-based leader election on a Redis lock, so that work meant to run once (e.g. scheduling) runs in exactly one process across replicas.
+    A background thread acquires the lock, and renews it every renew_interval seconds while it holds it. The lock expires after ttl seconds without renewal,
+    so another process takes over if the leader dies. Every leader gets a new, increasing fencing token.
+    Leader-only writes check the token against the fencing counter right before they happen, so that a stale leader (e.g. paused past its lease) cannot write.
+    A process only considers itself leader until its last renewal is ttl seconds old, even if its renewal thread stalls.
+    """
+    def __init__(self, redis_client: redis.Redis = redis_client, name: str = "scheduler", ttl: float = 15, renew_interval: float = 5):
+        self.redis = redis_client
+        self.lock_key = f"leader:{name}"
+        self.fence_key = f"leader:{name}:fence"
+        self.ttl = ttl
+        self.renew_interval = renew_interval
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.fencing_token = None  # Fencing token of the current leadership, None when not leader
+        self._lease_deadline = 0  # Monotonic time until which the leadership is known to be valid
+        self._acquire = self.redis.register_script(ACQUIRE_LEADERSHIP_SCRIPT)
+        self._renew = self.redis.register_script(RENEW_LEADERSHIP_SCRIPT)
+        self._release = self.redis.register_script(RELEASE_LEADERSHIP_SCRIPT)
+        self.thread = None
+        self._stop = threading.Event()
+
+    @property
+    def is_leader(self) -> bool:
+        """Whether this process currently holds the leadership."""
+        return self.fencing_token is not None and time.monotonic() < self._lease_deadline
+
+    @property
+    def fence(self) -> tuple:
+        """
+        Fencing counter key and fencing token of the current leadership, to guard the writes reserved to the leader (see JobManager.fence_holds).
+        Returns: (fence key, fencing token), None if this process is not the leader.
+        """
+        if not self.is_leader:
+            return None
+        return self.fence_key, self.fencing_token
+
+    def campaign(self) -> bool:
+        """
+        Acquire the leadership, or renew it if already held. One round trip.
+        Returns: True if this process is the leader.
+        """
+        started = time.monotonic()
+        ttl_ms = int(self.ttl * 1000)
+        try:
+            if self.fencing_token is not None:
+                if self._renew(keys=[self.lock_key, self.fence_key], args=[self.owner, ttl_ms, self.fencing_token]):
+                    self._lease_deadline = started + self.ttl
+                    return True
+                print(f"Lost leadership of {self.lock_key} (fencing token {self.fencing_token}).")
+                self.fencing_token = None
+            token = self._acquire(keys=[self.lock_key, self.fence_key], args=[self.owner, ttl_ms])
+            if token:
+                self.fencing_token = int(token)
+                self._lease_deadline = started + self.ttl
+                print(f"Acquired leadership of {self.lock_key} as {self.owner} (fencing token {self.fencing_token}).")
+                return True
+        except redis.RedisError as e:
+            # Keep the leadership until the lease deadline, a later renewal may still succeed
+            print(f"Error during leader election: {e}")
+        return self.is_leader
+
+    def resign(self):
+        """Release the leadership, so another process can take over without waiting for the lock to expire."""
+        if self.fencing_token is None:
+            return
+        self.fencing_token = None
+        try:
+            self._release(keys=[self.lock_key], args=[self.owner])
+            print(f"Released leadership of {self.lock_key}.")
+        except redis.RedisError as e:
+            print(f"Error while releasing leadership: {e}")
+
+    def run(self, stop: threading.Event):
+        """Campaign every renew_interval seconds until the stop event is set, then resign."""
+        while not stop.is_set():
+            self.campaign()
+            stop.wait(self.renew_interval)
+        self.resign()
+
+    def start(self):
+        """Start campaigning in a background thread."""
+        if self.thread and self.thread.is_alive():
+            return
+        self._stop.clear()
+        self.thread = threading.Thread(target=self.run, args=(self._stop,), name=f"leader-{self.lock_key}", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout: float = None):
+        """Stop campaigning and resign."""
+        self._stop.set()
+        if self.thread:
+            self.thread.join(timeout)
+            self.thread = None
@@ -0,0 +1,62 @@
+import asyncio
+from redis import asyncio as aioredis
+from app.core.redis import async_redis_client
+
+# Pub/sub channel on which the job manager announces newly queued jobs
+JOB_QUEUE_CHANNEL = "job_queue:notify"
+# Pub/sub channel on which the scheduler is woken up, e.g. when a job completes or a channel is created
+SCHEDULER_EVENTS_CHANNEL = "scheduler:events"
+
+
+class QueueNotifier:
+    """
+    Wake up the requests that are waiting for a job.
+    A single Redis pub/sub subscription per process is shared by all waiting requests: each notification bumps a generation counter and wakes the waiters.
+    """
+    def __init__(self, redis_client: aioredis.Redis = async_redis_client, channel: str = JOB_QUEUE_CHANNEL):
+        self.redis = redis_client
+        self.channel = channel
+        self.generation = 0  # Incremented every time jobs are queued
+        self.task = None  # Background listener task, started in main.lifespan
+        self._condition = asyncio.Condition()
+
+    async def _notify(self):
+        """Bump the generation and wake up all waiters."""
+        async with self._condition:
+            self.generation += 1
+            self._condition.notify_all()
+
+    async def listen(self):
+        """Listen for queue notifications. Runs as a background task, reconnecting on errors."""
+        while True:
+            pubsub = self.redis.pubsub()
+            try:
+                await pubsub.subscribe(self.channel)
+                # Notifications may have been missed while (re)subscribing. Wake up the waiters so they check the queue.
+                await self._notify()
+                async for message in pubsub.listen():
+                    if message["type"] == "message":
+                        await self._notify()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Exception in queue notifier: {e}")
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.reset()
+
+    async def wait(self, generation: int, timeout: float) -> bool:
+        """
+        Wait until jobs are queued after the given generation was observed, or until the timeout expires.
+        Returns: True if woken up by a notification, False on timeout.
+        """
+        async with self._condition:
+            try:
+                await asyncio.wait_for(self._condition.wait_for(lambda: self.generation != generation), timeout)
+                return True
+            except asyncio.TimeoutError:
+                return False
+
+
+# instantiate the notifier
+job_notifier = QueueNotifier()
@@ -1,6 +1,21 @@
-from redis import Redis
+from redis import Redis, BlockingConnectionPool
+from redis import asyncio as aioredis
+from app.core.config import RedisConfig
 
 # Redis Settings
-# Connect to Redis
+cfg = RedisConfig()
+connection_settings = {
+    "host": cfg.host,
+    "port": cfg.port,
+    "db": cfg.db,
+    "max_connections": cfg.max_connections,
+    "timeout": cfg.pool_timeout,
+    "socket_connect_timeout": cfg.socket_connect_timeout,
+    "health_check_interval": cfg.health_check_interval,
+}
+
+# Connect to Redis. Both clients share their pool across the whole process, connections are borrowed per command (or per pipeline).
 # TODO: Can we make this more secure? Redis is exposed to the internet.
-redis_client = Redis(host="redis", port=6379, db=0)
\ No newline at end of file
+redis_client = Redis(connection_pool=BlockingConnectionPool(**connection_settings))
+# Async client, for the code running on the event loop (endpoints, waiting for notifications). Never use the sync client there, it blocks the loop.
+async_redis_client = aioredis.Redis(connection_pool=aioredis.BlockingConnectionPool(**connection_settings))
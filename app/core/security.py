@@ -2,7 +2,7 @@ from passlib.context import CryptContext
 import jwt # Importing jwt from the PyJWT module. This will be used to generate and verify JWT tokens. 
 import datetime
 from fastapi import HTTPException, Header # Importing Header and HTTPException. 
-from app.core.redis import redis_client
+from app.core.redis import async_redis_client
 # Here we handle security functions. We check passwords and we issue/revoke tokens.
 
 
@@ -56,15 +56,15 @@ def verify_token(token: str):
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
-# Dependency to get the payload from token
-def get_current_user(authorization: str = Header(...)):
+# Dependency to get the payload from token. Async, so the revocation check does not block the event loop (or a threadpool thread).
+async def get_current_user(authorization: str = Header(...)):
     # FastAPI reads the name of the variable above ("authorization") and looks for a header with the same name. Underscores become dashes.
     # Get the token from the Authorization header (Bearer <token>)
     if not authorization.startswith("Bearer "):
         raise HTTPException(status_code=400, detail="Invalid authentication header format")
     token = authorization[7:]  # Extract the token part
     # Check if the token is revoked
-    if is_token_revoked(token):
+    if await is_token_revoked(token):
         raise HTTPException(status_code=401, detail="Token has been revoked")
     pl = verify_token(token) # This returns the token payload if token is valid
     # check that the token is an access token
@@ -72,11 +72,17 @@ def get_current_user(authorization: str = Header(...)):
         raise HTTPException(status_code=400, detail="Invalid token type")
     return pl
 
-def revoke_token(token: str):
-    redis_client.setex(f"blacklist:{token}", REFRESH_TOKEN_EXPIRE_DAYS * 24 * 60 * 60, "revoked")
+async def revoke_token(token: str):
+    """
+    Revoke a token, in a single round trip.
+    Returns: True if the token was revoked by this call, False if it was already revoked.
+    """
+    # SET NX both checks and revokes, so a token can only be revoked (e.g. a refresh token rotated) once, even by concurrent requests
+    revoked = await async_redis_client.set(f"blacklist:{token}", "revoked", ex=REFRESH_TOKEN_EXPIRE_DAYS * 24 * 60 * 60, nx=True)
     # Log the revoked token
-    print(f"Revoked token: {token}")
+    if revoked:
+        print(f"Revoked token: {token}")
+    return bool(revoked)
 
-def is_token_revoked(token: str):
-    print("Checking if token is revoked")
-    return redis_client.exists(f"blacklist:{token}")
\ No newline at end of file
+async def is_token_revoked(token: str):
+    return await async_redis_client.exists(f"blacklist:{token}")
\ No newline at end of file
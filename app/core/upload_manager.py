@@ -0,0 +1,295 @@
+import os
+import time
+import uuid
+import asyncio
+import hashlib
+from redis import asyncio as aioredis
+from app.core.config import FileHandlingConfig
+from app.core.redis import async_redis_client
+
+
+# The upload token and its session expire once no chunk arrived for upload_link_ttl seconds: every chunk extends their lifetime.
+
+# Files being uploaded, scored by the time of the last activity of their session. Their part files are removed once the session has expired (see remove_expired_parts).
+UPLOAD_PARTS_KEY = "upload_parts"
+
+# Start an upload session on its first chunk, or return the existing one, and extend its lifetime.
+# The file of the session is tracked in the upload parts, with the current time.
+# KEYS: upload token, session hash, chunk bitmap, chunk digests, chunk writes, upload parts. ARGV: session id, total chunks, file path, file id, ttl in milliseconds, current time.
+# Returns: session id, total chunks, file path, file id and finalized flag of the session. Nil if the token has expired.
+START_UPLOAD_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return false
+end
+if redis.call('EXISTS', KEYS[2]) == 0 then
+    redis.call('HSET', KEYS[2], 'session_id', ARGV[1], 'total_chunks', ARGV[2], 'file_path', ARGV[3], 'file_id', ARGV[4], 'received', 0, 'bytes', 0)
+end
+for i = 1, 5 do
+    redis.call('PEXPIRE', KEYS[i], ARGV[5])
+end
+redis.call('ZADD', KEYS[6], ARGV[6], redis.call('HGET', KEYS[2], 'file_path'))
+return redis.call('HMGET', KEYS[2], 'session_id', 'total_chunks', 'file_path', 'file_id', 'finalized')
+"""
+
+# Start writing a chunk, unless the upload is being finalized or is finalized: the part file must not be touched anymore.
+# Writes in flight are tracked in a sorted set (scored by expiry time), and prevent the finalization (see CLAIM_FINALIZATION_SCRIPT).
+# KEYS: session hash, chunk writes. ARGV: write id, current time, write expiry time (in seconds), ttl in milliseconds.
+# Returns: 1 if the chunk may be written, 0 otherwise.
+BEGIN_WRITE_SCRIPT = """
+local session = redis.call('HMGET', KEYS[1], 'finalized', 'finalizer')
+if session[1] or (session[2] and tonumber(session[2]) > tonumber(ARGV[2])) then
+    return 0
+end
+redis.call('ZADD', KEYS[2], ARGV[3], ARGV[1])
+redis.call('PEXPIRE', KEYS[2], ARGV[4])
+return 1
+"""
+
+# Mark a chunk as received, once it is written, record its digest, end its write, and extend the lifetime of the session. Chunk i is bit i - 1 of the bitmap.
+# KEYS: upload token, session hash, chunk bitmap, chunk digests, chunk writes. ARGV: chunk index, chunk size, ttl in milliseconds, chunk digest, write id.
+# Returns: the number of chunks received, 0 if the chunk was already received, -1 if the session has expired.
+MARK_CHUNK_SCRIPT = """
+redis.call('ZREM', KEYS[5], ARGV[5])
+if redis.call('EXISTS', KEYS[1]) == 0 or redis.call('EXISTS', KEYS[2]) == 0 then
+    return -1
+end
+local already = redis.call('SETBIT', KEYS[3], ARGV[1] - 1, 1)
+if already == 0 then
+    redis.call('HSET', KEYS[4], ARGV[1], ARGV[4])
+end
+for i = 1, #KEYS do
+    redis.call('PEXPIRE', KEYS[i], ARGV[3])
+end
+if already == 1 then
+    return 0
+end
+redis.call('HINCRBY', KEYS[2], 'bytes', ARGV[2])
+return redis.call('HINCRBY', KEYS[2], 'received', 1)
+"""
+
+# Claim the finalization of an upload, once all chunks are received and no chunk is being written. Only one request holds the claim at a time.
+# The claim expires, so that another request takes over if the finalizer dies. So do writes, if their request dies.
+# KEYS: session hash, chunk writes. ARGV: current time, claim expiry time (in seconds).
+# Returns: 1 if the claim was taken, 0 otherwise (chunks missing, chunks being written, already finalized, or claimed by another request).
+CLAIM_FINALIZATION_SCRIPT = """
+local session = redis.call('HMGET', KEYS[1], 'received', 'total_chunks', 'finalized', 'finalizer')
+if not session[1] or session[3] or tonumber(session[1]) < tonumber(session[2]) then
+    return 0
+end
+if session[4] and tonumber(session[4]) > tonumber(ARGV[1]) then
+    return 0
+end
+-- E.g. a chunk re-sent concurrently with its first copy: the last write to end finalizes
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])
+if redis.call('ZCARD', KEYS[2]) > 0 then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'finalizer', ARGV[2])
+return 1
+"""
+
+
+def session_key(token: str) -> str:
+    """Redis key of an upload session: a hash with the session ID, the expected number of chunks, the file path and ID, and the chunks and bytes received."""
+    return f"upload:{token}"
+
+def chunks_key(token: str) -> str:
+    """Redis key of the bitmap of the chunks received in an upload session."""
+    return f"upload:{token}:chunks"
+
+def digests_key(token: str) -> str:
+    """Redis key of the SHA-256 digests of the chunks received in an upload session: a hash from chunk index to hex digest."""
+    return f"upload:{token}:digests"
+
+def writes_key(token: str) -> str:
+    """Redis key of the chunk writes in flight in an upload session: a sorted set of write IDs, scored by expiry time."""
+    return f"upload:{token}:writes"
+
+def remove_part_file(file_path: str) -> int:
+    """Remove the part file of an upload, if it exists. Blocking, run it in a thread. Returns: 1 if removed, 0 otherwise."""
+    try:
+        os.remove(file_path + ".part")
+        return 1
+    except FileNotFoundError:
+        return 0
+
+def file_digest(chunk_digests: list) -> str:
+    """
+    Digest of a file uploaded in chunks: the SHA-256 of the concatenated (binary) SHA-256 digests of its chunks, in order.
+    Chunks arrive in any order, so the file digest is computed from the chunk digests, without reading the file again.
+    Clients verify a file by hashing it in chunks of the same size (stored with the file).
+    """
+    digest = hashlib.sha256()
+    for chunk_digest in chunk_digests:
+        digest.update(bytes.fromhex(chunk_digest))
+    return digest.hexdigest()
+
+
+class UploadManager:
+    """
+    Keep track of the chunked uploads in Redis, next to their upload token.
+    Every upload token has at most one session, started by its first chunk. Detecting the last chunk is a single atomic counter update,
+    whatever the number of uploads in flight. Chunks of a session may be uploaded concurrently: exactly one request finalizes the file (see claim_finalization).
+    """
+    def __init__(self, redis_client: aioredis.Redis = async_redis_client, config: FileHandlingConfig = FileHandlingConfig()):
+        self.redis = redis_client
+        self.config = config
+        self.task = None  # Background sweeper task, started in main.lifespan
+        self._start_upload = self.redis.register_script(START_UPLOAD_SCRIPT)
+        self._begin_write = self.redis.register_script(BEGIN_WRITE_SCRIPT)
+        self._mark_chunk = self.redis.register_script(MARK_CHUNK_SCRIPT)
+        self._claim_finalization = self.redis.register_script(CLAIM_FINALIZATION_SCRIPT)
+
+    def _keys(self, token: str) -> list:
+        """Keys of an upload: token, session hash, chunk bitmap, chunk digests and chunk writes."""
+        return [token, session_key(token), chunks_key(token), digests_key(token), writes_key(token)]
+
+    def _ttl_ms(self) -> int:
+        """Lifetime of an idle upload, in milliseconds."""
+        return self.config.upload_link_ttl * 1000
+
+    async def start_session(self, token: str, session_id: str, total_chunks: int, file_path: str, file_id: str):
+        """
+        Start the upload session of a token, or get the one started by an earlier chunk. The file path and ID are only used for a new session.
+        Returns: dict with session_id, total_chunks, file_path, file_id and finalized of the session, None if the token has expired.
+        """
+        session = await self._start_upload(keys=self._keys(token) + [UPLOAD_PARTS_KEY], args=[session_id, total_chunks, file_path, file_id, self._ttl_ms(), time.time()])
+        if not session:
+            return None
+        return {
+            "session_id": session[0].decode(),
+            "total_chunks": int(session[1]),
+            "file_path": session[2].decode(),
+            "file_id": session[3].decode(),
+            "finalized": session[4] is not None,
+        }
+
+    async def is_received(self, token: str, chunk_index: int) -> bool:
+        """Whether a chunk of the upload was already received."""
+        return bool(await self.redis.getbit(chunks_key(token), chunk_index - 1))
+
+    async def begin_write(self, token: str) -> str:
+        """
+        Start writing a chunk to the part file. End the write with mark_received once the chunk is written, or with end_write on failure.
+        Returns: the ID of the write, None if the upload is being finalized or is finalized (the chunk must not be written).
+        """
+        write_id = str(uuid.uuid4())
+        now = time.time()
+        args = [write_id, now, now + self.config.upload_finalize_timeout, self._ttl_ms()]
+        if not await self._begin_write(keys=[session_key(token), writes_key(token)], args=args):
+            return None
+        return write_id
+
+    async def end_write(self, token: str, write_id: str):
+        """End a chunk write that failed, so that it does not hold back the finalization."""
+        await self.redis.zrem(writes_key(token), write_id)
+
+    async def mark_received(self, token: str, chunk_index: int, size: int, digest: str, write_id: str) -> int:
+        """
+        Mark a chunk as received, with its SHA-256 digest, and end its write. Call it once the chunk is written.
+        Extends the lifetime of the upload, also for chunks received twice (e.g. re-sent after a dropped connection).
+        Returns: the number of chunks received so far, 0 if the chunk was already received, -1 if the session has expired.
+        """
+        return await self._mark_chunk(keys=self._keys(token), args=[chunk_index, size, self._ttl_ms(), digest, write_id])
+
+    async def missing_chunks(self, token: str):
+        """
+        List the chunks of an upload that were not received yet, and extend the lifetime of the upload (the client is about to resume it).
+        Returns: dict with total_chunks, received and the missing chunk indices, None if the session was not started or has expired.
+        """
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.hmget(session_key(token), "total_chunks", "received", "file_path")
+        pipe.get(chunks_key(token))
+        for key in self._keys(token):
+            pipe.pexpire(key, self._ttl_ms())
+        (total_chunks, received, file_path), bitmap = (await pipe.execute())[:2]
+        if total_chunks is None:
+            return None
+        # The session is still in use, keep its part file
+        await self.redis.zadd(UPLOAD_PARTS_KEY, {file_path: time.time()}, xx=True)
+        total_chunks = int(total_chunks)
+        bitmap = bitmap or b""
+        # SETBIT numbers the bits from the most significant bit of the first byte
+        missing = [
+            index + 1 for index in range(total_chunks)
+            if index // 8 >= len(bitmap) or not (bitmap[index // 8] >> (7 - index % 8)) & 1
+        ]
+        return {"total_chunks": total_chunks, "received": int(received), "missing": missing}
+
+    async def file_size(self, token: str) -> int:
+        """Size of the uploaded file, once all chunks are received. None if the session has expired."""
+        size = await self.redis.hget(session_key(token), "bytes")
+        return int(size) if size is not None else None
+
+    async def get_file_digest(self, token: str, total_chunks: int) -> str:
+        """Digest of the uploaded file (see file_digest), once all chunks are received. None if a chunk digest is missing (e.g. the session expired)."""
+        chunk_digests = await self.redis.hmget(digests_key(token), list(range(1, total_chunks + 1)))
+        if any(chunk_digest is None for chunk_digest in chunk_digests):
+            return None
+        return file_digest([chunk_digest.decode() for chunk_digest in chunk_digests])
+
+    async def claim_finalization(self, token: str) -> bool:
+        """
+        Claim the finalization of an upload: true for exactly one request once all chunks are received and written.
+        No chunk write starts while the claim is held (see begin_write).
+        The claim is released on failure (see release_finalization), or expires after upload_finalize_timeout seconds.
+        """
+        now = time.time()
+        return bool(await self._claim_finalization(keys=[session_key(token), writes_key(token)], args=[now, now + self.config.upload_finalize_timeout]))
+
+    async def release_finalization(self, token: str):
+        """Release the finalization claim after a failure, so that the next request (e.g. a re-sent chunk) retries."""
+        await self.redis.hdel(session_key(token), "finalizer")
+
+    async def mark_finalized(self, token: str, file_path: str):
+        """
+        Mark an upload as finalized. The token cannot upload anything anymore,
+        but re-sent chunks (e.g. the client missed the response) are told the upload succeeded until the session expires.
+        """
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.hset(session_key(token), "finalized", 1)
+        pipe.zrem(UPLOAD_PARTS_KEY, file_path)
+        await pipe.execute()
+
+    async def end_session(self, token: str):
+        """Invalidate the upload token, drop its session and remove its part file."""
+        file_path = await self.redis.hget(session_key(token), "file_path")
+        await self.redis.delete(*self._keys(token))
+        if file_path:
+            await asyncio.to_thread(remove_part_file, file_path.decode())
+            await self.redis.zrem(UPLOAD_PARTS_KEY, file_path)
+
+    async def remove_expired_parts(self):
+        """
+        Remove the part files of the upload sessions that have expired, e.g. abandoned by the client.
+        A session expires upload_link_ttl seconds after its last activity, a finalizer may still be working on it for upload_finalize_timeout seconds.
+        Returns: the number of part files removed.
+        """
+        cutoff = time.time() - self.config.upload_link_ttl - self.config.upload_finalize_timeout
+        file_paths = await self.redis.zrangebyscore(UPLOAD_PARTS_KEY, "-inf", cutoff)
+        if not file_paths:
+            return 0
+        removed = 0
+        for file_path in file_paths:
+            removed += await asyncio.to_thread(remove_part_file, file_path.decode())
+        await self.redis.zrem(UPLOAD_PARTS_KEY, *file_paths)
+        print(f"Removed {removed} part files of expired uploads")
+        return removed
+
+    async def sweep(self):
+        """Remove the part files of expired uploads periodically. Runs as a background task, started in main.lifespan."""
+        while True:
+            try:
+                await self.remove_expired_parts()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Exception in upload sweeper: {e}")
+            await asyncio.sleep(self.config.upload_link_ttl)
+
+
+# ------------------------------
+# Upload Manager logic
+# ------------------------------
+
+upload_manager = UploadManager()
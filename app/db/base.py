@@ -1,5 +1,8 @@
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, scoped_session, declarative_base
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from app.core.config import DatabaseConfig
+from app.db.pool import InstrumentedQueuePool, InstrumentedAsyncQueuePool
 
 # Get the password from the Docker secret (at /run/secrets/db_password)
 with open("/run/secrets/db_password", "r") as file:
@@ -7,12 +10,34 @@ with open("/run/secrets/db_password", "r") as file:
 
 # Database URL
 DATABASE_URL = f"postgresql://quantumhive:{db_password}@db:5432/quantumhive"
+# Same database, through the asyncpg driver (used by the async endpoints)
+ASYNC_DATABASE_URL = f"postgresql+asyncpg://quantumhive:{db_password}@db:5432/quantumhive"
+
+cfg = DatabaseConfig()
+# Connection pool settings, shared by both engines
+pool_settings = {
+    "pool_size": cfg.pool_size,
+    "max_overflow": cfg.max_overflow,
+    "pool_timeout": cfg.pool_timeout,
+    "pool_pre_ping": cfg.pool_pre_ping,
+    "pool_recycle": cfg.pool_recycle,
+}
 
 # Create the database engine
-engine = create_engine(DATABASE_URL)
+engine = create_engine(DATABASE_URL, poolclass=InstrumentedQueuePool, **pool_settings)
 SessionFactory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base() # Base class for the ORM models (to be inherited by the models)
 
+# Create the async database engine. Objects stay usable after commit, since lazy loading is not possible in async code.
+# Prepared statements are cached per connection, both by asyncpg and by the SQLAlchemy dialect.
+async_engine = create_async_engine(
+    f"{ASYNC_DATABASE_URL}?prepared_statement_cache_size={cfg.prepared_statement_cache_size}",
+    poolclass=InstrumentedAsyncQueuePool,
+    connect_args={"statement_cache_size": cfg.prepared_statement_cache_size},
+    **pool_settings
+)
+AsyncSessionFactory = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
+
 # Dependency to get the database session (called in the API endpoints to get the database session)
 def get_db():
     """Creates and provides a session for each request."""
@@ -24,4 +49,17 @@ def get_db():
         session.rollback()  # Rollback on error
         raise  # Re-raise the exception
     finally:
-        session.close()  # Automatically removes session after request finishes
\ No newline at end of file
+        session.close()  # Automatically removes session after request finishes
+
+# Dependency to get an async database session (for the async endpoints, so that database calls do not block the event loop)
+async def get_async_db():
+    """Creates and provides an async session for each request."""
+    session = AsyncSessionFactory()
+    try:
+        yield session  # Return session to the caller
+        await session.commit()  # Commit changes after processing the request
+    except:
+        await session.rollback()  # Rollback on error
+        raise  # Re-raise the exception
+    finally:
+        await session.close()  # Automatically removes session after request finishes
@@ -0,0 +1,26 @@
+from sqlalchemy import text
+
+# Schema changes made after the first release. create_all only creates missing tables and init.sql only runs on an empty database,
+# so existing databases are brought up to date with these idempotent statements, run in order at startup.
+MIGRATIONS = [
+    # Composite indexes used by the set-based TTL sweeps (JobManager.manage_jobs)
+    "CREATE INDEX IF NOT EXISTS ix_jobs_status_last_update ON jobs (status, last_update)",
+    "CREATE INDEX IF NOT EXISTS ix_jobs_status_time_started ON jobs (status, time_started)",
+    # Marks the completed jobs already applied to their channel (ChannelManager._process_completed_batch)
+    "ALTER TABLE jobs ADD COLUMN IF NOT EXISTS time_processed TIMESTAMP",
+    # Digest of uploaded files and the chunk size it was computed over (served on download)
+    "ALTER TABLE files ADD COLUMN IF NOT EXISTS digest VARCHAR(64)",
+    "ALTER TABLE files ADD COLUMN IF NOT EXISTS chunk_size INTEGER",
+]
+
+def run_migrations(engine):
+    """
+    Apply the schema migrations, each in its own transaction.
+    A failing statement is reported and skipped, so that the others still run (e.g. when another replica applies the same migration concurrently).
+    """
+    for statement in MIGRATIONS:
+        try:
+            with engine.begin() as connection:
+                connection.execute(text(statement))
+        except Exception as e:
+            print(f"Migration failed: {statement}: {e}")
@@ -0,0 +1,68 @@
+import threading
+import time
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+
+
+class PoolWaitStats:
+    """Thread-safe counters of how long connection checkouts wait for the pool."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def record(self, wait: float, timed_out: bool = False):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            if timed_out:
+                self.timeouts += 1
+
+
+class WaitTimeMixin:
+    """Measure the time spent waiting for a connection. Mixed into the SQLAlchemy queue pools."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wait_stats = PoolWaitStats()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            timed_out = True
+            raise
+        finally:
+            self.wait_stats.record(time.perf_counter() - start, timed_out)
+
+
+class InstrumentedQueuePool(WaitTimeMixin, QueuePool):
+    """Queue pool of the sync engine, with wait time statistics."""
+
+
+class InstrumentedAsyncQueuePool(WaitTimeMixin, AsyncAdaptedQueuePool):
+    """Queue pool of the async engine, with wait time statistics."""
+
+
+def pool_stats(pool) -> dict:
+    """Live statistics of a connection pool: usage, overflow and time spent waiting for a connection."""
+    stats = {
+        "size": pool.size(),
+        "checked_in": pool.checkedin(),
+        "checked_out": pool.checkedout(),
+        "overflow": pool.overflow(),
+    }
+    wait_stats = getattr(pool, "wait_stats", None)
+    if wait_stats:
+        stats.update({
+            "checkouts": wait_stats.checkouts,
+            "timeouts": wait_stats.timeouts,
+            "wait_total_seconds": wait_stats.wait_total,
+            "wait_max_seconds": wait_stats.wait_max,
+            "wait_avg_seconds": wait_stats.wait_total / wait_stats.checkouts if wait_stats.checkouts else 0.0,
+        })
+    return stats
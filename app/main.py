@@ -1,10 +1,13 @@
 # Import and include your routers
-from app.api.v1.endpoints import users, auth, jobs, downloads, channels
+from app.api.v1.endpoints import users, auth, jobs, downloads, channels, stats
 from fastapi.middleware.cors import CORSMiddleware
 from app.core.job_manager import job_manager
 from app.db.base import engine, Base
+from app.db.migrations import run_migrations
 from app.models.job import JobType, JobStatus
 from app.core.channel_manager import channel_manager
+from app.core.notifier import job_notifier
+from app.core.upload_manager import upload_manager
 import asyncio
 from contextlib import asynccontextmanager
 from fastapi import FastAPI
@@ -17,19 +20,32 @@ async def lifespan(app: FastAPI):
     """Handles startup and shutdown events for the background task."""
     print("Starting FastAPI app with background task...")
     
-    # Start the background task
-    channel_manager.task = asyncio.create_task(channel_manager.update())
+    # Start the scheduler thread, unless it runs as its own process (python -m app.scheduler)
+    if channel_manager.config.scheduler_in_api:
+        channel_manager.start()
+    # Listen for queued jobs, to wake up the workers waiting in /jobs/request
+    job_notifier.task = asyncio.create_task(job_notifier.listen())
+    # Remove the part files of abandoned uploads
+    upload_manager.task = asyncio.create_task(upload_manager.sweep())
 
     yield  # Let FastAPI start
 
     # Cleanup on shutdown
     print("Shutting down background task...")
-    if channel_manager.task:
-        channel_manager.task.cancel()
+    # Let the current tick finish without blocking the event loop
+    await asyncio.to_thread(channel_manager.stop, 2 * channel_manager.config.update_interval)
+    if job_notifier.task:
+        job_notifier.task.cancel()
         try:
-            await channel_manager.task
+            await job_notifier.task
         except asyncio.CancelledError:
-            print("Background task was cancelled")
+            print("Queue notifier was cancelled")
+    if upload_manager.task:
+        upload_manager.task.cancel()
+        try:
+            await upload_manager.task
+        except asyncio.CancelledError:
+            print("Upload sweeper was cancelled")
 
 app = FastAPI(title="QuantumHiveAPI", lifespan=lifespan)
 
@@ -41,10 +57,13 @@ app.include_router(auth.router, prefix="/auth", tags=["auth"])
 app.include_router(jobs.router, prefix="/jobs", tags=["jobs"])
 app.include_router(downloads.router, prefix="/files", tags=["jobs"])
 app.include_router(channels.router, prefix="/channels", tags=["channels"])
+app.include_router(stats.router, prefix="/stats", tags=["stats"])
 
 
 # Create DB tables (if they don’t exist)
 Base.metadata.create_all(bind=engine)
+# Bring existing databases up to date (columns and indexes added after the tables were created)
+run_migrations(engine)
 
 
 # CORS (Allow frontend access)
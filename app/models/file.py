@@ -1,5 +1,5 @@
 import uuid
-from sqlalchemy import Column, String
+from sqlalchemy import Column, String, Integer
 from sqlalchemy.types import Enum
 from sqlalchemy.ext.declarative import declarative_base
 import enum
@@ -19,6 +19,8 @@ class File(Base):
     id = Column(String(8), primary_key=True, default=generate_unique_id, unique=True, index=True)
     type = Column(Enum(FileTypeEnum), nullable=False)  # Specifies the type of file, restricted to "kraus" or "vector"
     full_path = Column(String(255), nullable=False, unique=True)  # Stores the absolute path to the file, ensuring uniqueness
+    digest = Column(String(64), nullable=True)  # SHA-256 of the SHA-256 digests of the chunks of the file (see upload_manager.file_digest)
+    chunk_size = Column(Integer, nullable=True)  # Size of the chunks the digest was computed over
 
     def __repr__(self):
         return f"<File(id={self.id}, type={self.type}, full_path={self.full_path})>"
\ No newline at end of file
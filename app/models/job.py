@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, func, Enum, Double
+from sqlalchemy import Column, Integer, String, DateTime, func, Enum, Double, Index
 from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import relationship
 from app.db.base import Base
@@ -34,4 +34,10 @@ class Job(Base):
     worker_id = Column(String)
     channel_id = Column(Integer, nullable=True)
     priority = Column(Integer, default=1)
+    time_processed = Column(DateTime)  # When the channel manager processed the completion of the job, so it is processed only once
 
+    # Back the periodic sweeps of the job manager (e.g. running jobs whose worker has not pinged in a while)
+    __table_args__ = (
+        Index("ix_jobs_status_last_update", "status", "last_update"),
+        Index("ix_jobs_status_time_started", "status", "time_started"),
+    )
@@ -0,0 +1,28 @@
+# Standalone scheduler process. Runs the channel manager loop outside of the API, e.g. as its own service:
+#   SCHEDULER_IN_API=0 uvicorn app.main:app ...   (API replicas)
+#   python -m app.scheduler                       (scheduler)
+import signal
+import threading
+from app.core.channel_manager import channel_manager
+from app.db.base import engine
+from app.db.migrations import run_migrations
+
+
+def main():
+    stop = threading.Event()
+
+    def handle_signal(signum, frame):
+        print(f"Received signal {signum}, stopping the scheduler...")
+        stop.set()
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    # The scheduler may start before any API replica, make sure the schema is up to date
+    run_migrations(engine)
+    print("Starting scheduler...")
+    channel_manager.run(stop)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,7 @@
 # Pydantic models are used to define the structure of the data that will be sent and received by the API. 
 
 from pydantic import BaseModel, Field
+from typing import Optional
 
 class FileDownloadRequestBase(BaseModel):
     file_id : str
@@ -10,6 +11,8 @@ class FileDownloadRequestBase(BaseModel):
 
 class FileResponseBase(BaseModel):
     download_url: str
+    digest: Optional[str] = None  # Digest of the file, to verify it (or skip downloading a file already held)
+    chunk_size: Optional[int] = None  # Size of the chunks the digest is computed over
 
 class FileUploadRequestBase(BaseModel):
     job_id: int
@@ -25,4 +28,5 @@ class FileUploadRequestBase(BaseModel):
         orm_mode = True
 
 class FileUploadResponseBase(BaseModel):
-    upload_url: str
\ No newline at end of file
+    upload_url: str
+    chunk_size: int  # Size of the chunks to upload, in bytes. Only the last chunk may be shorter.
\ No newline at end of file
@@ -3,7 +3,7 @@
 # Pydantic models are used to define the structure of the data that will be sent and received by the API. 
 
 from pydantic import BaseModel
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional
 
 class JobBase(BaseModel):
     job_id: int
@@ -19,6 +19,12 @@ class JobCreate(BaseModel):
     input_data: Dict[str, Any]  
     kraus_operator: str
     vector: str
+    priority: int = 1
+
+class JobPrioritize(BaseModel):
+    priority: int
+    job_ids: Optional[List[int]] = None  # Pending jobs to re-prioritize
+    channel_id: Optional[int] = None  # Re-prioritize all pending jobs of this channel
 
 class JobRequestModel(BaseModel):
     job_id: int    
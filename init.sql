@@ -47,13 +47,20 @@ CREATE TABLE jobs (
     last_update TIMESTAMP,
     worker_id TEXT,  -- Assigned worker (nullable initially)
     channel_id INTEGER, -- Reference to the channel, null if not assigned
-    priority INTEGER DEFAULT 1
+    priority INTEGER DEFAULT 1,
+    time_processed TIMESTAMP  -- When the channel manager processed the completion of the job
 );
 
+-- Indexes backing the periodic job sweeps (e.g. running jobs whose worker has not pinged in a while)
+CREATE INDEX IF NOT EXISTS ix_jobs_status_last_update ON jobs (status, last_update);
+CREATE INDEX IF NOT EXISTS ix_jobs_status_time_started ON jobs (status, time_started);
+
 CREATE TABLE files (
     id VARCHAR(8) PRIMARY KEY,
     type VARCHAR(50) NOT NULL CHECK (type IN ('kraus', 'vector')),
-    full_path VARCHAR(255) NOT NULL UNIQUE
+    full_path VARCHAR(255) NOT NULL UNIQUE,
+    digest VARCHAR(64),  -- SHA-256 of the SHA-256 digests of the file chunks
+    chunk_size INTEGER  -- Size of the chunks the digest was computed over
 );
 
 
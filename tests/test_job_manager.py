@@ -0,0 +1,57 @@
+# Tests of the job manager against an in-memory Redis (fakeredis, with Lua support) and a stub database session.
+# Run inside the API image (the database password secret must be readable): python -m pytest tests
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("lupa")  # Lua scripts
+
+try:
+    from app.core.job_manager import JobManager, JOB_QUEUE_CHANNEL
+    from app.models.job import JobType
+except Exception as e:  # e.g. the database secret is missing outside of the containers
+    pytest.skip(f"Cannot import the job manager: {e}", allow_module_level=True)
+
+
+class StubSession:
+    """Just enough of a SQLAlchemy session for create_job: assigns an ID on refresh."""
+    def __init__(self, job_id: int):
+        self.job_id = job_id
+
+    def add(self, job):
+        pass
+
+    def commit(self):
+        pass
+
+    def refresh(self, job):
+        job.id = self.job_id
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def redis_client():
+    return fakeredis.FakeRedis()
+
+
+@pytest.fixture
+def manager(redis_client, monkeypatch):
+    manager = JobManager(redis_client)
+    monkeypatch.setattr(manager, "_get_session", lambda: StubSession(42))
+    return manager
+
+
+def test_create_job_queues_the_job(manager, redis_client):
+    pubsub = redis_client.pubsub()
+    pubsub.subscribe(JOB_QUEUE_CHANNEL)
+    pubsub.get_message(timeout=1)  # Subscription confirmation
+
+    job = manager.create_job(JobType.generate_vector, {"input_dimension": 2}, channel_id=1)
+
+    assert job.id == 42
+    assert redis_client.zscore("job_queue", 42) is not None
+    assert redis_client.hget("job_descriptors", 42) is not None
+    # Workers waiting in /jobs/request are woken up
+    message = pubsub.get_message(ignore_subscribe_messages=True, timeout=1)
+    assert message is not None and message["channel"] == JOB_QUEUE_CHANNEL.encode()